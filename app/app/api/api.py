@@ -1,5 +1,5 @@
 from fastapi import APIRouter
-from . import login, users, chats, utils
+from . import login, users, chats, utils, metrics
 
 api_router = APIRouter()
 
@@ -7,3 +7,4 @@ api_router.include_router(login.router, tags=["login"])
 api_router.include_router(users.router, prefix="/users", tags=["users"])
 api_router.include_router(chats.router, prefix="/chats", tags=["chats"])
 api_router.include_router(utils.router, prefix="/utils", tags=["utils"])
+api_router.include_router(metrics.router, prefix="/metrics", tags=["metrics"])
@@ -12,16 +12,20 @@ from fastapi.encoders import jsonable_encoder
 from firebase_admin import messaging, auth
 import firebase_admin
 from pydantic import EmailStr
-from starlette.responses import JSONResponse, FileResponse
+from starlette.responses import JSONResponse
 
 from app.app.backend.user import get_user_info
-from app.app.backend.exceptions import PermissionDenied, NotInitialised, ObjectNotFound
+from app.app.backend.exceptions import PermissionDenied, NotInitialised, ObjectNotFound, InvalidRange
 from app.app.src.schemas.chat import ChatCreate
 from app.app.backend.chat import get_info, add_user, remove_user, make_user_admin, create, create_personal, \
     set_non_admin, set_user_expandable, set_non_removable_messages, set_non_modifiable_messages, \
     set_auto_remove_messages, set_digest_messages, get_message, get_message_range, send_message, edit_message, \
     delete_message, get_chats_for_user, get_messages_with_tag, create_upload_file, get_attachment, send_system_message, \
-    add_to_white_list
+    add_to_white_list, next_message_cursor, sync, get_inbox, inbox_cursor, mark_read, get_tag_counts, \
+    search_messages, search_cursor
+from app.app.backend.storage import content_hash_of
+from app.app.backend.thumbnails import thumbnail_pool, get_thumbnail, thumbnails_done, is_image
+from app.app.src.files import AttachmentResponse, REVALIDATE
 from app.app.src.security import decode_token, oauth2_scheme
 
 logging.basicConfig(level=logging.INFO)
@@ -94,22 +98,33 @@ async def req_get_message(message_id: int, token: str = Depends(decode_token)) -
 
 
 @router.get('/get_message_range')
-async def req_get_message_range(chat_id: int, limit: int = 50, token: str = Depends(decode_token)) -> Any:
+async def req_get_message_range(chat_id: int, limit: int = Query(50, ge=1, le=500), before: Optional[str] = None,
+                                after: Optional[str] = None, token: str = Depends(decode_token)) -> Any:
     """
-    **Retrieve messages in the specified time range in a specific chat.**
+    **Retrieve a page of messages in a specific chat.**
+
+    Without a cursor the newest messages are returned, newest first. Pass the value of the **X-Next-Cursor**
+    response header as **before** to scroll back through older messages (newest first), or as **after** to
+    fetch messages sent after it (oldest first). The header is absent once the start of the chat is reached.
 
     Return a **list** containing messages (the same as get_message)
 
     **Exceptions:**
+    * Status code **400**
     * Status code **403**
     * Status code **404**
     """
     try:
         user_id = token["id"]
-        messages = await get_message_range(current_user=user_id, chat_id=chat_id, limit=limit)
-        # log.info(messages)
+        messages = await get_message_range(current_user=user_id, chat_id=chat_id, limit=limit, before=before,
+                                           after=after)
+        headers = {}
+        if next_cursor := next_message_cursor(messages, limit, after):
+            headers["X-Next-Cursor"] = next_cursor
         messages = jsonable_encoder(messages)
-        return JSONResponse(content=messages)
+        return JSONResponse(content=messages, headers=headers)
+    except InvalidRange:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except PermissionDenied:
         raise HTTPException(status_code=403, detail="Permission denied")
     except ObjectNotFound:
@@ -120,8 +135,47 @@ async def req_get_message_range(chat_id: int, limit: int = 50, token: str = Depe
 async def get_attachments(file_uri: str, chat_id: int, token: str = Depends(decode_token)):
     try:
         user_id = token["id"]
-        path = await get_attachment(file_uri=file_uri, chat_id=chat_id, current_user=user_id)
-        return FileResponse(path=path, media_type='application/octet-stream', filename=os.path.basename(path))
+        source = await get_attachment(file_uri=file_uri, chat_id=chat_id, current_user=user_id)
+        # Stored files are named by their content hash, the download keeps the name of the source
+        return AttachmentResponse(path=source["path_original"], content_hash=await content_hash_of(source),
+                                  filename=file_uri)
+    except PermissionDenied:
+        raise HTTPException(status_code=403, detail="Permission denied")
+    except ObjectNotFound:
+        raise HTTPException(status_code=404, detail="Resource wasn't found")
+
+
+@router.get("/download_thumbnail/{file_uri}")
+async def get_thumbnail_of_attachment(file_uri: str, chat_id: int, size: int = Query(256, ge=1, le=4096),
+                                      token: str = Depends(decode_token)):
+    """
+    **Download a preview of an image attachment**
+
+    Previews are made in the background after the upload in a few sizes (`PP_THUMBNAIL_SIZES`, 64, 256 and 640
+    pixels by default). The smallest preview at least **size** pixels wide and high is returned, or the largest
+    one when all are smaller.
+
+    While the previews are not ready yet, or when the image cannot be decoded, the original is returned instead
+    with `Cache-Control: no-cache`, so clients ask again later. Previews themselves never change.
+
+    **Exceptions:**
+    * Status code **403**
+    * Status code **404** - also when the attachment is not an image
+    """
+    try:
+        user_id = token["id"]
+        source = await get_attachment(file_uri=file_uri, chat_id=chat_id, current_user=user_id)
+        if not is_image(file_uri):
+            raise ObjectNotFound()
+        content_hash = await content_hash_of(source)
+        if thumbnail := await get_thumbnail(content_hash, size):
+            return AttachmentResponse(path=thumbnail["path"], content_hash=f"{content_hash}-{thumbnail['size']}",
+                                      filename=os.path.splitext(file_uri)[0] + os.path.splitext(thumbnail["path"])[1])
+        # Uploads from before the pipeline, or a queue that was lost on restart, are picked up here
+        if not await thumbnails_done(content_hash):
+            thumbnail_pool.enqueue(content_hash, source["path_original"])
+        return AttachmentResponse(path=source["path_original"], content_hash=content_hash, filename=file_uri,
+                                  cache_control=REVALIDATE)
     except PermissionDenied:
         raise HTTPException(status_code=403, detail="Permission denied")
     except ObjectNotFound:
@@ -149,28 +203,166 @@ async def req_get_chats_for_user(token: str = Depends(decode_token)) -> Any:
     #     raise HTTPException(status_code=500, detail="Something went wrong, but we are already working on it :)")
 
 
+@router.get('/inbox')
+async def req_get_inbox(limit: int = Query(20, ge=1, le=100), before: Optional[str] = None,
+                        token: str = Depends(decode_token)) -> Any:
+    """
+    **Retrieve the user's chats with their last message and unread count, most recently active first.**
+
+    Pass the value of the **X-Next-Cursor** response header as **before** to get the next page. The header is
+    absent on the last page.
+
+    Return a **list** of **dicts** containing the following keys:
+
+    * **id**, **name**, **avatar**, **color_rgba**, **encoded** – the chat
+    * **members** – the number of participants
+    * **last_activity** – the time of the last message
+    * **last_seq** – the seq of the last message
+    * **last_read_seq** – the seq of the last message the user has read
+    * **unread** – the number of unread messages
+    * **last_message_id**, **last_message_author**, **last_message_time**, **last_message_preview**,
+      **last_message_has_attachment** – the last message, all null in a chat without messages
+
+    **Exceptions:**
+    * Status code **400**
+    """
+    try:
+        user_id = token["id"]
+        chats = await get_inbox(current_user=user_id, limit=limit, before=before)
+        headers = {"X-Next-Cursor": inbox_cursor(chats[-1])} if len(chats) == limit else {}
+        return JSONResponse(content=jsonable_encoder(chats), headers=headers)
+    except InvalidRange:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.post('/mark_read')
+async def req_mark_read(chat_id: int, seq: int, token: str = Depends(decode_token)) -> Any:
+    """
+    **Mark the messages of a chat as read up to the given seq.**
+
+    Return JSON string `{'result': true}`.
+
+    **Exceptions:**
+    * Status code **403**
+    """
+    try:
+        user_id = token["id"]
+        result = await mark_read(current_user=user_id, chat_id=chat_id, seq=seq)
+        return {'result': result}
+    except PermissionDenied:
+        raise HTTPException(status_code=403, detail="Permission denied")
+
+
+@router.get('/sync')
+async def req_sync(since: Optional[str] = None, limit: int = Query(200, ge=1, le=1000),
+                   token: str = Depends(decode_token)) -> Any:
+    """
+    **Retrieve what changed in the user's chats since the last sync.**
+
+    Call without **since** once the full state has been loaded to get a token for the present. Afterwards pass the
+    **next** token of the previous response; while **has_more** is true, call again right away.
+
+    Return a **dict** containing the following keys:
+
+    * **changes** – a list of changes, oldest first, each with **chat_id**, **kind** (message_created,
+      message_edited, message_deleted, member_added, member_updated, member_removed, chat_updated), **object_id**
+      (the message or the user), **data** (the new admin flag or the changed chat properties), **message** (the
+      current message for message_created and message_edited) and **time**
+    * **next** – the token for the next call
+    * **has_more** – whether more changes are waiting
+
+    **Exceptions:**
+    * Status code **400**
+    """
+    try:
+        user_id = token["id"]
+        return await sync(current_user=user_id, since=since, limit=limit)
+    except InvalidRange:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+
 @router.get('/get_messages_with_tag')
-async def req_get_messages_with_tag(chat_id: int, tag: str,
+async def req_get_messages_with_tag(chat_id: int, tag: List[str] = Query(...),
+                                    match: str = Query("all", regex="^(all|any)$"),
+                                    limit: int = Query(50, ge=1, le=500), before: Optional[str] = None,
                                     token: str = Depends(decode_token)) -> Any:
     """
-    **Retrieve messages with the specified tag in a specific chat.**
+    **Retrieve messages with the specified tags in a specific chat, newest first.**
+
+    Repeat **tag** to search for several tags; **match** is **all** (every tag must be present) or **any**.
+    Pass the value of the **X-Next-Cursor** response header as **before** to get older messages. The header is
+    absent once the start of the chat is reached.
 
     Return a **list** containing messages (the same as get_message)
 
     **Exceptions:**
+    * Status code **400**
     * Status code **403**
     * Status code **404**
     """
     try:
         user_id = token["id"]
-        messages = await get_messages_with_tag(current_user=user_id, chat_id=chat_id, tag=tag)
-        return messages
+        messages = await get_messages_with_tag(current_user=user_id, chat_id=chat_id, tags=tag, match=match,
+                                               limit=limit, before=before)
+        headers = {}
+        if next_cursor := next_message_cursor(messages, limit):
+            headers["X-Next-Cursor"] = next_cursor
+        return JSONResponse(content=jsonable_encoder(messages), headers=headers)
+    except InvalidRange:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except PermissionDenied:
         raise HTTPException(status_code=403, detail="Permission denied")
     except ObjectNotFound:
         raise HTTPException(status_code=404, detail="Resource wasn't found")
 
 
+@router.get('/search')
+async def req_search(q: str, chat_id: Optional[int] = None, limit: int = Query(20, ge=1, le=100),
+                     after: Optional[str] = None, token: str = Depends(decode_token)) -> Any:
+    """
+    **Search the messages of the user's chats, best matches first.**
+
+    **q** accepts web search syntax: words, "quoted phrases", **or** and **-excluded** words. Pass **chat_id** to
+    search a single chat. Pass the value of the **X-Next-Cursor** response header as **after** to get the next
+    page; the header is absent on the last page.
+
+    Return a **list** of **dicts** containing the following keys:
+
+    * **id**, **chat_attached_id**, **seq**, **author_id**, **sent_time**, **tag_list**, **has_attached_file** –
+      the message, see get_message
+    * **rank** – the relevance of the message
+    * **snippet** – the matching parts of the body with the matches wrapped in **<b>** tags
+
+    **Exceptions:**
+    * Status code **400**
+    """
+    try:
+        user_id = token["id"]
+        results = await search_messages(current_user=user_id, query=q, chat_id=chat_id, limit=limit, after=after)
+        headers = {"X-Next-Cursor": search_cursor(results[-1])} if len(results) == limit else {}
+        return JSONResponse(content=jsonable_encoder(results), headers=headers)
+    except InvalidRange:
+        raise HTTPException(status_code=400, detail="Invalid query or cursor")
+
+
+@router.get('/tag_counts')
+async def req_get_tag_counts(chat_id: int, limit: int = Query(100, ge=1, le=1000),
+                             token: str = Depends(decode_token)) -> Any:
+    """
+    **Retrieve how many messages of a chat carry each tag.**
+
+    Return a **list** of **dicts** with the keys **tag** and **count**, most frequent first.
+
+    **Exceptions:**
+    * Status code **403**
+    """
+    try:
+        user_id = token["id"]
+        return await get_tag_counts(current_user=user_id, chat_id=chat_id, limit=limit)
+    except PermissionDenied:
+        raise HTTPException(status_code=403, detail="Permission denied")
+
+
 @router.post('/create')
 async def req_create_chat(info: ChatCreate, token: str = Depends(decode_token)) -> Any:
     """
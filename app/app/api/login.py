@@ -10,11 +10,12 @@ from fastapi.security import OAuth2PasswordRequestForm
 from firebase_admin import auth, messaging
 from starlette.responses import JSONResponse
 
-from app.app.backend.exceptions import NotInitialised, AuthenticationError, NickTaken, EmailTaken, ObjectNotFound
+from app.app.backend.exceptions import NotInitialised, AuthenticationError, NickTaken, EmailTaken, ObjectNotFound, \
+    Overloaded
 from app.app.src import schemas
 # from app.app.backend import user, NickTaken, EmailTaken, AuthenticationError, ObjectNotFound, get_user_info
-from app.app.backend.user import insert_fcm_token, delete_fcm_token, check_duplicate_fcm_token, temporary_registration, \
-    verification_attempt, authenticate, register, get_user_info
+from app.app.backend.user import insert_fcm_token, delete_fcm_token, temporary_registration, verification_attempt, \
+    authenticate, register, get_user_info
 from app.app.src.security import create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, decode_token
 from app.app.utils import send_verification_email
 
@@ -33,6 +34,7 @@ async def login_for_access_token(fcm_token: Optional[str] = None, form_data: OAu
 
     **Exceptions**
     * Status code **401**
+    * Status code **503**
     """
     try:
         user_id = await authenticate(nick=form_data.username, password=form_data.password)
@@ -49,12 +51,13 @@ async def login_for_access_token(fcm_token: Optional[str] = None, form_data: OAu
         )
 
         if fcm_token is not None:
-            await check_duplicate_fcm_token(fcm_token=fcm_token)
             await insert_fcm_token(current_user=user_id, fcm_token=fcm_token)
 
         return {"access_token": access_token, "token_type": "bearer", "id": user_id}
     except AuthenticationError:
         raise HTTPException(status_code=401, detail="Invalid username or password")
+    except Overloaded:
+        raise HTTPException(status_code=503, detail="Server is busy, try again later", headers={"Retry-After": "1"})
     # except NotInitialised:
     #     HTTPException(status_code=501, detail="Sorry, we have some problems on server")
 
@@ -70,6 +73,7 @@ async def create_user(
 
     **Exceptions:**
     * Status code **422**
+    * Status code **503**
     """
     try:
         await register(nick=user_in.nick, password=user_in.password, email=user_in.email, name=user_in.name)
@@ -98,6 +102,8 @@ async def create_user(
         raise HTTPException(status_code=422, detail="Nick is taken")
     except EmailTaken:
         raise HTTPException(status_code=422, detail="Email is taken")
+    except Overloaded:
+        raise HTTPException(status_code=503, detail="Server is busy, try again later", headers={"Retry-After": "1"})
     # except NotInitialised:
     #     HTTPException(status_code=501, detail="Sorry, we have some problems on server")
 
@@ -0,0 +1,49 @@
+from typing import Any, Dict
+
+from fastapi import APIRouter, Depends
+
+from app.app.backend.cache import identity_cache, chat_tokens_cache, chat_info_cache, membership_index
+from app.app.backend.bus import delivery_bus
+from app.app.backend.fanout import fanout
+from app.app.backend.hashing import hashing_pool
+from app.app.backend.push import push_gateway
+from app.app.backend.replay import replay_buffer
+from app.app.backend.thumbnails import thumbnail_pool
+from app.app.src.security import decode_token
+from app.app.src.connections import connections
+
+router = APIRouter()
+
+
+@router.get("/")
+async def get_metrics(token: str = Depends(decode_token)) -> Dict[str, Any]:
+    """
+    **Obtain runtime metrics of this server process.**
+
+    Return a **dict** containing the following keys:
+
+    * **identity_cache** – size and hit rate of the authenticated identity cache
+    * **chat_info_cache** – size and hit rate of the chat info cache
+    * **membership_index** – size and hit rate of the chat membership index
+    * **hashing** – load, rejections, queue wait and hash time of the password hashing pool
+    * **fanout** – queue depth and drops of the message delivery stage
+    * **websockets** – connected users and sockets (live, idle, reaped), outbound queue depth and dropped frames
+    * **replay** – chats and frames held for reconnecting clients, and how often they covered the gap
+    * **delivery_bus** – events published to and received from the other server processes, queued and dropped ones
+    * **thumbnails** – queue depth and counters of the image preview pipeline
+    * **push** – queue depth and delivery counters of the push gateway
+    * **push_tokens_cache** – size and hit rate of the per-chat push token cache
+    """
+    return {
+        "identity_cache": identity_cache.stats(),
+        "chat_info_cache": chat_info_cache.stats(),
+        "membership_index": membership_index.stats(),
+        "hashing": hashing_pool.stats(),
+        "fanout": fanout.stats(),
+        "websockets": connections.stats(),
+        "replay": replay_buffer.stats(),
+        "delivery_bus": delivery_bus.stats(),
+        "thumbnails": thumbnail_pool.stats(),
+        "push": push_gateway.stats(),
+        "push_tokens_cache": chat_tokens_cache.stats(),
+    }
@@ -2,7 +2,7 @@ from typing import Optional
 
 from pydantic import EmailStr
 
-from app.app.backend.exceptions import ObjectNotFound
+from app.app.backend.exceptions import ObjectNotFound, Overloaded
 from app.app.backend.user import get_user_info, delete_user_system, change_pass, change_email
 from fastapi import APIRouter, HTTPException, Depends
 from app.app.src.schemas import user
@@ -41,6 +41,8 @@ async def update_pass(passwd: str, token: str = Depends(decode_token)):
         return {"status": True}
     except ObjectNotFound:
         raise HTTPException(status_code=404, detail="Resource wasn't found")
+    except Overloaded:
+        raise HTTPException(status_code=503, detail="Server is busy, try again later", headers={"Retry-After": "1"})
 
 
 @router.post("/update_email")
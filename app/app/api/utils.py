@@ -1,12 +1,12 @@
-import os
 from typing import List, Optional
 
 from fastapi import APIRouter, UploadFile, Depends, File, HTTPException
-from starlette.responses import FileResponse
 
 from app.app.backend.chat import create_upload_file, get_attachment
 from app.app.backend.utils import get_attachment
 from app.app.backend.exceptions import PermissionDenied, ObjectNotFound
+from app.app.backend.storage import content_hash_of
+from app.app.src.files import AttachmentResponse
 from app.app.src.security import decode_token
 
 router = APIRouter()
@@ -36,8 +36,10 @@ async def upload_attachments(is_showable: bool = True, description: Optional[str
 async def get_attachments(file_uri: str, token: str = Depends(decode_token)):
     try:
         user_id = token["id"]
-        path = await get_attachment(file_uri=file_uri)
-        return FileResponse(path=path, media_type='application/octet-stream', filename=os.path.basename(path))
+        source = await get_attachment(file_uri=file_uri)
+        # Stored files are named by their content hash, the download keeps the name of the source
+        return AttachmentResponse(path=source["path_original"], content_hash=await content_hash_of(source),
+                                  filename=file_uri)
     except ObjectNotFound:
         raise HTTPException(status_code=404, detail="Resource wasn't found")
 
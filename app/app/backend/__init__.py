@@ -1,9 +1,11 @@
 import asyncpg
 from app.app.settings import Settings
 from app.app.backend import config
+from app.app.backend.utils import worker_lease, set_worker_id
 
 
 async def init(settings: Settings):
+    config.settings = settings
     config.db = await asyncpg.create_pool(
         host=settings.db_host,
         port=settings.db_port,
@@ -11,3 +13,9 @@ async def init(settings: Settings):
         user=settings.db_user,
         password=settings.db_pass,
     )
+    # Ids are minted per process; every process needs its own worker id
+    if settings.worker_id is None:
+        set_worker_id(await worker_lease.acquire())
+        worker_lease.start()
+    else:
+        set_worker_id(settings.worker_id)
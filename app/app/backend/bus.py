@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app.app.backend import config
+
+log = logging.getLogger(__name__)
+
+CHANNEL = "pp_delivery"
+
+# Identifies this process in published events, so it can skip its own echoes when it wants to
+NODE = uuid.uuid4().hex[:12]
+
+PayloadHandler = Callable[[str], Awaitable[None]]
+EventHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class LocalTransport:
+    """Delivers published payloads to this process only. Enough for a single worker."""
+
+    def __init__(self):
+        self._on_payload: Optional[PayloadHandler] = None
+
+    async def start(self, on_payload: PayloadHandler) -> None:
+        self._on_payload = on_payload
+
+    async def publish(self, payload: str) -> None:
+        await self._on_payload(payload)
+
+    async def close(self) -> None:
+        self._on_payload = None
+
+
+class PostgresTransport:
+    """
+    Fans payloads out to every process connected to the database with
+    LISTEN/NOTIFY. One connection of the asyncpg pool is held for listening;
+    publishing borrows any connection. Notifications are put on bounded
+    queues, one per worker task, so a burst of events cannot turn into an
+    unbounded number of concurrent queries. Events are sharded by their
+    chat id, which keeps the events of one chat in the order they came.
+    """
+
+    def __init__(self, channel: str = CHANNEL, reconnect_delay: float = 1.0, queue_size: int = 10000,
+                 workers: int = 8):
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.queue_size = queue_size
+        self.workers = workers
+        self.dropped = 0
+        self._on_payload: Optional[PayloadHandler] = None
+        self._connection = None
+        self._closing = False
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._reconnecting: Optional[asyncio.Task] = None
+
+    async def start(self, on_payload: PayloadHandler) -> None:
+        self._on_payload = on_payload
+        self._closing = False
+        if not self._tasks:
+            self._queues = [asyncio.Queue(maxsize=max(1, self.queue_size // self.workers))
+                            for _ in range(self.workers)]
+            self._tasks = [asyncio.ensure_future(self._worker(queue)) for queue in self._queues]
+        self._connection = await config.db.acquire()
+        self._connection.add_termination_listener(self._on_terminated)
+        await self._connection.add_listener(self.channel, self._on_notify)
+
+    async def publish(self, payload: str) -> None:
+        await config.db.execute("SELECT pg_notify($1, $2);", self.channel, payload)
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+            self._reconnecting = None
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            try:
+                await connection.remove_listener(self.channel, self._on_notify)
+            finally:
+                await config.db.release(connection)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def join(self) -> None:
+        for queue in self._queues:
+            await queue.join()
+
+    def _shard(self, payload: str) -> asyncio.Queue:
+        try:
+            chat_id = json.loads(payload).get("c")
+        except (ValueError, AttributeError):
+            chat_id = None
+        return self._queues[chat_id % self.workers if isinstance(chat_id, int) else 0]
+
+    def _on_notify(self, _connection, _pid: int, _channel: str, payload: str) -> None:
+        try:
+            self._shard(payload).put_nowait(payload)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log.warning(f"Delivery bus queue is full, dropping event {payload}")
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            payload = await queue.get()
+            try:
+                await self._on_payload(payload)
+            except Exception:
+                log.exception(f"Delivery bus event {payload} failed")
+            finally:
+                queue.task_done()
+
+    def _on_terminated(self, _connection) -> None:
+        if not self._closing:
+            log.warning("Delivery bus lost its listening connection, reconnecting")
+            self._connection = None
+            self._reconnecting = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        while not self._closing:
+            try:
+                await self.start(self._on_payload)
+                self._reconnecting = None
+                return
+            except Exception as e:
+                log.warning(f"Delivery bus reconnect failed: {e!r}")
+                await asyncio.sleep(self.reconnect_delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": sum(queue.qsize() for queue in self._queues),
+            "dropped": self.dropped,
+        }
+
+
+class DeliveryBus:
+    """
+    Small pub/sub bus between the server processes. Events are compact JSON
+    objects with a type under "t" and a few ids; receivers hydrate anything
+    else they need locally. The transport is pluggable.
+    """
+
+    def __init__(self, transport: Any = None):
+        self.transport = transport or LocalTransport()
+        self.started = False
+        self.published = 0
+        self.received = 0
+        self.failed = 0
+        self._handlers: Dict[str, EventHandler] = {}
+
+    def on(self, kind: str, handler: EventHandler) -> None:
+        self._handlers[kind] = handler
+
+    async def start(self) -> None:
+        if not self.started:
+            await self.transport.start(self._dispatch)
+            self.started = True
+
+    async def close(self) -> None:
+        if self.started:
+            await self.transport.close()
+            self.started = False
+
+    async def publish(self, kind: str, **fields: Any) -> None:
+        payload = json.dumps({"t": kind, "n": NODE, **fields}, separators=(",", ":"))
+        self.published += 1
+        if self.started:
+            await self.transport.publish(payload)
+        else:
+            # Not connected yet: nobody else can hear us, but local sockets still get the event
+            await self._dispatch(payload)
+
+    async def _dispatch(self, payload: str) -> None:
+        self.received += 1
+        try:
+            event = json.loads(payload)
+            if handler := self._handlers.get(event.pop("t", None)):
+                await handler(event)
+        except Exception:
+            self.failed += 1
+            log.exception(f"Delivery bus event {payload} failed")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "transport": type(self.transport).__name__,
+            "started": self.started,
+            "published": self.published,
+            "received": self.received,
+            "failed": self.failed,
+            **(self.transport.stats() if hasattr(self.transport, "stats") else {}),
+        }
+
+
+delivery_bus = DeliveryBus(PostgresTransport(queue_size=config.settings.delivery_bus_queue_size,
+                                             workers=config.settings.delivery_bus_workers)
+                           if config.settings.delivery_bus == "postgres" else LocalTransport())
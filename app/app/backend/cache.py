@@ -0,0 +1,183 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Set
+
+from app.app.backend import config
+
+_MISSING = object()
+
+
+class TTLCache:
+    """In-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            self._removed(key, value)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if (entry := self._data.get(key, _MISSING)) is not _MISSING:
+            self._removed(key, entry[1])
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            evicted, (_, old) = self._data.popitem(last=False)
+            self._removed(evicted, old)
+
+    def invalidate(self, key: Hashable) -> None:
+        if (entry := self._data.pop(key, _MISSING)) is not _MISSING:
+            self._removed(key, entry[1])
+
+    def _removed(self, key: Hashable, value: Any) -> None:
+        """Called for every value that leaves the cache, so subclasses can keep their indexes in step."""
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key, _MISSING)
+        return entry is not _MISSING and entry[0] >= time.monotonic()
+
+    def hit_rate(self) -> Optional[float]:
+        total = self.hits + self.misses
+        return self.hits / total if total else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate(),
+        }
+
+
+class ChatTokensCache(TTLCache):
+    """
+    Push tokens of the participants of a chat, keyed by chat id. The chats
+    are also indexed by user and by token, so a login or logout only drops
+    the entries it affects.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._by_user: Dict[int, Set[int]] = {}
+        self._by_token: Dict[str, Set[int]] = {}
+
+    def get_tokens(self, chat_id: int, users: Iterable[int]) -> Optional[Dict[int, List[str]]]:
+        entry = self.get(chat_id)
+        if entry is None or entry[0] != frozenset(users):
+            return None
+        return entry[1]
+
+    def put_tokens(self, chat_id: int, users: Iterable[int], tokens: Dict[int, List[str]]) -> None:
+        users = frozenset(users)
+        self.put(chat_id, (users, tokens))
+        for user_id in users:
+            self._by_user.setdefault(user_id, set()).add(chat_id)
+        for user_tokens in tokens.values():
+            for token in user_tokens:
+                self._by_token.setdefault(token, set()).add(chat_id)
+
+    def _removed(self, chat_id: int, value: Any) -> None:
+        users, tokens = value
+        for user_id in users:
+            _unindex(self._by_user, user_id, chat_id)
+        for user_tokens in tokens.values():
+            for token in user_tokens:
+                _unindex(self._by_token, token, chat_id)
+
+    def clear(self) -> None:
+        super().clear()
+        self._by_user.clear()
+        self._by_token.clear()
+
+    def forget_user(self, user_id: int) -> None:
+        for chat_id in list(self._by_user.get(user_id, ())):
+            self.invalidate(chat_id)
+
+    def forget_tokens(self, tokens: Iterable[str]) -> None:
+        for chat_id in set().union(*(self._by_token.get(token, ()) for token in tokens)):
+            self.invalidate(chat_id)
+
+
+def _unindex(index: Dict[Hashable, Set[int]], key: Hashable, chat_id: int) -> None:
+    if (chat_ids := index.get(key)) is not None:
+        chat_ids.discard(chat_id)
+        if not chat_ids:
+            del index[key]
+
+
+class VersionedCache(TTLCache):
+    """
+    TTLCache with a version counter per key. bump() invalidates an entry and
+    makes a value loaded before the bump unstorable, so a slow reader cannot
+    put back data that a concurrent writer has already changed.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._versions: "OrderedDict[Hashable, int]" = OrderedDict()
+
+    def version(self, key: Hashable) -> int:
+        return self._versions.get(key, 0)
+
+    def bump(self, key: Hashable) -> None:
+        self._versions[key] = self.version(key) + 1
+        self._versions.move_to_end(key)
+        while len(self._versions) > 4 * self.maxsize:
+            self._versions.popitem(last=False)
+        self.invalidate(key)
+
+    def get_current(self, key: Hashable) -> Any:
+        entry = self.get(key)
+        if entry is None or entry[0] != self.version(key):
+            return None
+        return entry[1]
+
+    def put_versioned(self, key: Hashable, version: int, value: Any) -> None:
+        if version == self.version(key):
+            self.put(key, (version, value))
+
+
+class MembershipIndex(VersionedCache):
+    """Participants of a chat with their admin flags, keyed by chat id."""
+
+    def set_member(self, chat_id: int, user_id: int, is_admin: bool) -> None:
+        members = self.get_current(chat_id)
+        self.bump(chat_id)
+        if members is not None:
+            self.put_versioned(chat_id, self.version(chat_id), {**members, user_id: is_admin})
+
+    def discard_member(self, chat_id: int, user_id: int) -> None:
+        members = self.get_current(chat_id)
+        self.bump(chat_id)
+        if members is not None:
+            self.put_versioned(chat_id, self.version(chat_id),
+                               {member: is_admin for member, is_admin in members.items() if member != user_id})
+
+
+identity_cache = TTLCache(config.settings.identity_cache_size, config.settings.identity_cache_ttl)
+chat_tokens_cache = ChatTokensCache(config.settings.push_tokens_cache_size, config.settings.push_tokens_cache_ttl)
+chat_info_cache = VersionedCache(config.settings.chat_info_cache_size, config.settings.chat_info_cache_ttl)
+membership_index = MembershipIndex(config.settings.membership_index_size, config.settings.membership_index_ttl)
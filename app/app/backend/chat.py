@@ -1,44 +1,84 @@
+import asyncio
 import json
 import os
 from datetime import datetime
 import logging
-import shutil
 import uuid
 from typing import Optional, Any, Dict, List, Tuple
 
+from asyncpg import Connection
 from fastapi import UploadFile
-from firebase_admin import messaging
 
 from app.app.backend import config
-from app.app.backend.utils import db_required, insert_with_unique_id, insert_without_unique_id
+from app.app.backend.cache import chat_tokens_cache, chat_info_cache, membership_index
+from app.app.backend.utils import db_required, insert_with_unique_id, insert_without_unique_id, encode_cursor, \
+    decode_cursor, generate_id
 from app.app.backend.exceptions import PermissionDenied, ObjectNotFound, InvalidRange
-from app.app.backend.user import get_user_info
-from app.app.src.websockets import connections
+from app.app.backend.bus import delivery_bus, NODE
+from app.app.backend.fanout import fanout
+from app.app.backend.push import push_gateway, PushNotification
+from app.app.backend.replay import replay_buffer
+from app.app.backend.storage import store_blob, discard_new_blobs
+from app.app.backend.thumbnails import thumbnail_pool, is_image
+from app.app.backend.user import get_user_info, get_identity
+from app.app.src.connections import connections
+from app.app.src.wire import Frame
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+VOLATILE_CHAT_COLUMNS = ("last_seq", "last_activity")
+
+# Everything but the search vector, which clients have no use for
+MESSAGE_COLUMNS = "id, chat_attached_id, seq, author_id, sent_time, tag_list, body, has_attached_file, was_modified"
+
+
+async def __chat_changed__(chat_id: int) -> None:
+    chat_info_cache.bump(chat_id)
+    await delivery_bus.publish("chat", c=chat_id)
+
+
+async def __message_changed__(chat_id: int, seq: int) -> None:
+    replay_buffer.evict(chat_id, seq)
+    await delivery_bus.publish("message_changed", c=chat_id, s=seq)
+
+
+async def __on_message_changed_event__(event: Dict[str, Any]) -> None:
+    # The frame another process recorded for the message is stale
+    if event["n"] != NODE:
+        replay_buffer.evict(event["c"], event["s"])
+
+
+async def __on_chat_event__(event: Dict[str, Any]) -> None:
+    # Another process changed the chat, forget what this one has cached about it
+    if event["n"] != NODE:
+        chat_info_cache.bump(event["c"])
+        membership_index.bump(event["c"])
+        chat_tokens_cache.invalidate(event["c"])
+
+
+@db_required
+async def __get_members__(chat_id: int) -> Dict[int, bool]:
+    version = membership_index.version(chat_id)
+    if (members := membership_index.get_current(chat_id)) is None:
+        members = {
+            record["participant_id"]: record["is_admin"]
+            for record in await config.db.fetch(
+                "SELECT participant_id, is_admin FROM chat_participants WHERE chat_id = $1;", chat_id
+            )
+        }
+        membership_index.put_versioned(chat_id, version, members)
+    return members
+
 
 @db_required
 async def has_user(user_id: int, chat_id: int):
-    return bool(
-        await config.db.fetchrow(
-            "SELECT * FROM chat_participants WHERE participant_id = $1 AND chat_id = $2;",
-            user_id,
-            chat_id,
-        )
-    )
+    return user_id in await __get_members__(chat_id)
 
 
 @db_required
 async def is_user_admin(user_id: int, chat_id: int):
-    return bool(
-        await config.db.fetchrow(
-            "SELECT * FROM chat_participants WHERE participant_id = $1 AND chat_id = $2 AND is_admin;",
-            user_id,
-            chat_id,
-        )
-    )
+    return (await __get_members__(chat_id)).get(user_id, False)
 
 
 @db_required
@@ -50,18 +90,29 @@ async def __get_info__(chat_id: int) -> Dict[str, Any]:
 
 @db_required
 async def get_info(current_user: int, chat_id: int) -> Dict[str, Any]:
-    if not await has_user(current_user, chat_id) and current_user != 1:
+    version = chat_info_cache.version(chat_id)
+    if (info := chat_info_cache.get_current(chat_id)) is None:
+        members_version = membership_index.version(chat_id)
+        if not (record := await config.db.fetchrow(
+                "SELECT c.*, "
+                "coalesce(array_agg(p.participant_id) FILTER (WHERE p.is_admin), '{}') AS admins, "
+                "coalesce(array_agg(p.participant_id) FILTER (WHERE p.participant_id IS NOT NULL), '{}') AS users "
+                "FROM chats c LEFT JOIN chat_participants p ON p.chat_id = c.id WHERE c.id = $1 GROUP BY c.id",
+                chat_id,
+        )):
+            if current_user != 1:
+                raise PermissionDenied()
+            raise ObjectNotFound()
+        info = dict(record)
+        # Counters that move with every message would make the entry stale at once
+        for column in VOLATILE_CHAT_COLUMNS:
+            info.pop(column, None)
+        chat_info_cache.put_versioned(chat_id, version, info)
+        membership_index.put_versioned(chat_id, members_version,
+                                       {user: user in info["admins"] for user in info["users"]})
+    if current_user not in info["users"] and current_user != 1:
         raise PermissionDenied()
-    res = await __get_info__(chat_id)
-    res["admins"] = []
-    res["users"] = []
-    for record in await config.db.fetch(
-            "SELECT participant_id, is_admin FROM chat_participants WHERE chat_id = $1", chat_id
-    ):
-        if record["is_admin"]:
-            res["admins"].append(record["participant_id"])
-        res["users"].append(record["participant_id"])
-    return res
+    return {**info, "admins": list(info["admins"]), "users": list(info["users"])}
 
 
 @db_required
@@ -70,12 +121,21 @@ async def __is_chat_non_admin__(chat_id: int) -> bool:
 
 
 @db_required
-async def __add_user__(chat_id: int, user_to_add: int, is_admin: bool = False) -> bool:
+async def __add_user__(chat_id: int, user_to_add: int, is_admin: bool = False,
+                       con: Optional[Connection] = None) -> bool:
     # TODO add except on "chat_participants_participant_id_fkey"
-    await insert_without_unique_id("CHAT_PARTICIPANTS",
-                                   ("participant_id", "chat_id", "is_admin"),
-                                   (user_to_add, chat_id, is_admin),
-                                   )
+    # New members start with the history read, like migration 005 did for existing ones
+    await (con or config.db).execute(
+        "INSERT INTO chat_participants (participant_id, chat_id, is_admin, last_read_seq) "
+        "VALUES ($1, $2, $3, coalesce((SELECT last_seq FROM chats WHERE id = $2), 0));",
+        user_to_add, chat_id, is_admin,
+    )
+    if con is None:
+        chat_tokens_cache.invalidate(chat_id)
+        await __chat_changed__(chat_id)
+        membership_index.set_member(chat_id, user_to_add, is_admin)
+    # Inside a transaction the caller announces the change once it is committed,
+    # otherwise other processes would reload and cache the state before the commit
     return True
 
 
@@ -100,6 +160,9 @@ async def __remove_user__(chat_id: int, user_to_remove: int) -> bool:
         chat_id,
         user_to_remove,
     )
+    chat_tokens_cache.invalidate(chat_id)
+    await __chat_changed__(chat_id)
+    membership_index.discard_member(chat_id, user_to_remove)
     participants = dict(
         await config.db.fetchrow("Select exists(select '*' from chat_participants Where chat_id = $1);",
                                  chat_id))
@@ -132,12 +195,36 @@ async def make_user_admin(current_user: str, chat_id: int, target_user: int) ->
                 chat_id,
                 target_user,
             )
+            await __chat_changed__(chat_id)
+            membership_index.set_member(chat_id, target_user, True)
             return True
         else:
             return False
     raise PermissionDenied()
 
 
+@db_required
+async def __create__(
+        con: Connection,
+        current_user_id: int,
+        name: str,
+        avatar: Optional[str],
+        color_rgba: int,
+        encoded: bool,
+        chat_id: Optional[int] = None,
+) -> int:
+    if chat_id is None:
+        chat_id = await insert_with_unique_id("chats", ("name", "creator", "avatar", "color_rgba", "encoded"),
+                                              (name, current_user_id, avatar, color_rgba, encoded), con=con)
+    else:
+        await con.execute(
+            "INSERT INTO chats (id, name, creator, avatar, color_rgba, encoded) VALUES ($1, $2, $3, $4, $5, $6);",
+            chat_id, name, current_user_id, avatar, color_rgba, encoded,
+        )
+    await __add_user__(chat_id, current_user_id, True, con=con)
+    return chat_id
+
+
 @db_required
 async def create(
         current_user_id: int,
@@ -149,46 +236,38 @@ async def create(
 ) -> Dict[str, Any]:
     async with config.db.acquire() as con:
         async with con.transaction():
-            res_id = await insert_with_unique_id(
-                "chats",
-                (
-                    "name",
-                    "creator",
-                    "avatar",
-                    "COLOR_RGBA",
-                    "ENCODED",
-                    # "PROPERTIES_LIST",
-                ),
-                (
-                    name,
-                    current_user_id,
-                    avatar,
-                    color_rgba,
-                    encoded,
-                    #     properties_list,
-                ),
-            )
-            await __add_user__(res_id, current_user_id, True)
+            res_id = await __create__(con, current_user_id, name, avatar, color_rgba, encoded)
+    await __chat_changed__(res_id)
     return await get_info(current_user_id, res_id)
 
 
+def __personal_pair__(user1: int, user2: int) -> Tuple[int, int]:
+    return (user1, user2) if user1 < user2 else (user2, user1)
+
+
 @db_required
 async def create_personal(current_user: int, user2: int) -> Dict[str, Any]:
-    if await get_personal_chat(current_user, user2):
+    """Return the personal chat of the two users, creating it if they have none yet."""
+    if current_user == user2:
         raise PermissionDenied()
+    if chat_id := await get_personal_chat(current_user, user2):
+        return await get_info(current_user, chat_id)
     u1 = await get_user_info(current_user, current_user)
     u2 = await get_user_info(current_user, user2)
     async with config.db.acquire() as con:
         async with con.transaction():
-            res = await create(
-                current_user,
-                name=f'{u1["nick"]} и {u2["nick"]}',
-                is_personal=True,
-                is_user_expandable=False,
-                is_non_admin=True,
+            # Claiming the pair first makes a concurrent creator wait here and then see our chat
+            chat_id = await con.fetchval(
+                "INSERT INTO personal_chats (user_low, user_high, chat_id) VALUES ($1, $2, $3) "
+                "ON CONFLICT DO NOTHING RETURNING chat_id;",
+                *__personal_pair__(current_user, user2), generate_id(),
             )
-            await __add_user__(res["id"], user2)
-    return await get_info(current_user, res["id"])
+            if chat_id is not None:
+                await __create__(con, current_user, f'{u1["nick"]} и {u2["nick"]}', None, 0, False, chat_id=chat_id)
+                await __add_user__(chat_id, user2, con=con)
+    if chat_id is not None:
+        await __chat_changed__(chat_id)
+    return await get_info(current_user, chat_id or await get_personal_chat(current_user, user2))
 
 
 @db_required
@@ -200,6 +279,7 @@ async def set_non_admin(current_user: str, chat_id: str, value: bool) -> bool:
             current_user,
             chat_id,
         )
+        await __chat_changed__(chat_id)
         return True
     raise PermissionDenied()
 
@@ -217,13 +297,14 @@ async def __set_property__(
             current_user,
             chat_id,
         )
+        await __chat_changed__(chat_id)
         return True
     raise PermissionDenied
 
 
 @db_required
 async def set_user_expandable(current_user: str, chat_id: str, value: bool) -> bool:
-    if (await __get_info__(chat_id))["is_personal"]:
+    if await __is_personal__(chat_id):
         raise PermissionDenied()
     return await __set_property__(current_user, chat_id, "is_user_expandable", value)
 
@@ -258,6 +339,7 @@ async def set_auto_remove_messages(
             await config.db.execute(
                 "UPDATE chats SET auto_remove_period=$1 WHERE id=$2", period, chat_id
             )
+    await __chat_changed__(chat_id)
     return True
 
 
@@ -285,7 +367,7 @@ async def __get_message__(
         message_id: int, include_extra_fields: bool = False
 ) -> Dict[str, Any]:
     if res := await config.db.fetchrow(
-            "SELECT * FROM messages WHERE id=$1", message_id
+            f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE id=$1", message_id
     ):
         res = dict(res)
         # if include_extra_fields:
@@ -302,56 +384,68 @@ async def get_message(current_user: int, message_id: int):
     raise PermissionDenied()
 
 
+def message_cursor(message: Dict[str, Any]) -> str:
+    return encode_cursor(message["seq"])
+
+
+def next_message_cursor(messages: List[Dict[str, Any]], limit: int, after: Optional[str] = None) -> Optional[str]:
+    if after:
+        return message_cursor(messages[-1]) if messages else after
+    if len(messages) == limit:
+        return message_cursor(messages[-1])
+    return None
+
+
 @db_required
 async def get_message_range(
-        current_user: int, chat_id: int, limit: int = 50
+        current_user: int, chat_id: int, limit: int = 50, before: Optional[str] = None, after: Optional[str] = None
 ) -> List[Dict[str, Any]]:
-    if await has_user(current_user, chat_id):
-        # if not lower_id and not upper_id:
-        #     raise InvalidRange()
-        # lower_message = await __get_message__(lower_id) if lower_id else None
-        # upper_message = await __get_message__(upper_id) if upper_id else None
-        # if (lower_message and upper_message) and (
-        #         lower_message["chat_attached_id"] != upper_message["chat_attached_id"]
-        # ):
-        #     raise InvalidRange()
-        # chat_id = lower_message["chat_attached_id"] if lower_message else upper_message["chat_attached_id"]
-        # if not await has_user(current_user, chat_id):
-        #     raise PermissionDenied()
-        # if lower_message and upper_message:
-        # lower_message = datetime.date(lower_id)
-        # upper_message = datetime.date(upper_id)
-
-        # lower_message = datetime.strptime(lower_date, "%Y-%m-%d %H:%M:%S.%f %z")
-        # upper_message = datetime.strptime(upper_date, "%Y-%m-%d %H:%M:%S.%f %z")
-
-        if message_list := await config.db.fetch(
-                "select * from messages where chat_attached_id = $1 and sent_time > ('2010-9-29 23:24:51.154352+03')::timestamptz Order by sent_time desc LIMIT $2;",
-                # "select * from messages where chat_attached_id = $1 and sent_time between $2 and $3 LIMIT $4;",
-                chat_id,
-                limit,
-        ):
-            return message_list
-        raise ObjectNotFound()
-        # message_list["sent_time"] = datetime.strftime("%Y-%m-%d %H:%M:%S.%f %z")
-        # elif not lower_message:
-        #     message_list = await config.db.fetch(
-        #         "SELECT * FROM messages WHERE chat_attached_id=$1 AND sent_time <= $2 ORDER BY sent_time DESC LIMIT $3",
-        #         chat_id,
-        #         upper_message["sent_time"],
-        #         limit,
-        #     )
-        # elif not upper_message:
-        #     message_list = await config.db.fetch(
-        #         "SELECT * FROM messages WHERE chat_attached_id=$1 AND sent_time >= $2 ORDER BY sent_time DESC LIMIT $3",
-        #         chat_id,
-        #         lower_message["sent_time"],
-        #         limit,
-        #     )
-        # for idx, item in enumerate(message_list):
-        #     message_list[idx] = dict(item)
-        #     await __message_add_extra_fields__(message_list[idx])
-    raise PermissionDenied()
+    if before and after:
+        raise InvalidRange()
+    if not await has_user(current_user, chat_id):
+        raise PermissionDenied()
+    if after:
+        # Catching up: the oldest messages newer than the cursor come first
+        (seq,) = decode_cursor(after, (int,))
+        return await config.db.fetch(
+            f"select {MESSAGE_COLUMNS} from messages where chat_attached_id = $1 and seq > $2 order by seq limit $3;",
+            chat_id,
+            seq,
+            limit,
+        )
+    if before:
+        (seq,) = decode_cursor(before, (int,))
+        return await config.db.fetch(
+            f"select {MESSAGE_COLUMNS} from messages where chat_attached_id = $1 and seq < $2 "
+            f"order by seq desc limit $3;",
+            chat_id,
+            seq,
+            limit,
+        )
+    if message_list := await config.db.fetch(
+            f"select {MESSAGE_COLUMNS} from messages where chat_attached_id = $1 order by seq desc limit $2;",
+            chat_id,
+            limit,
+    ):
+        return message_list
+    raise ObjectNotFound()
+
+
+@db_required
+async def replay_messages(current_user: int, chat_id: int, last_seq: int, limit: int) -> Tuple[List[Frame], bool]:
+    """
+    Frames of the messages after `last_seq`, from the replay buffer when it
+    still holds all of them and from the database otherwise. The flag tells
+    whether the client is fully caught up or has to page for the rest.
+    """
+    if not await has_user(current_user, chat_id):
+        raise PermissionDenied()
+    # The ring only moves on bus events, the committed head tells whether this process missed some
+    head = await config.db.fetchval("SELECT last_seq FROM chats WHERE id = $1;", chat_id)
+    if (frames := replay_buffer.since(chat_id, last_seq, head or 0)) is not None:
+        return frames, True
+    messages = await get_message_range(current_user, chat_id, limit=limit + 1, after=encode_cursor(last_seq))
+    return [Frame({**m, "message_type": "message"}) for m in messages[:limit]], len(messages) <= limit
 
 
 @db_required
@@ -370,15 +464,30 @@ async def __send_message__(
         raise PermissionDenied()
     async with config.db.acquire() as con:
         async with con.transaction():
+            # Row lock on the chat serialises senders of this chat only
+            seq = await con.fetchval(
+                "UPDATE chats SET last_seq = last_seq + 1, last_activity = current_timestamp WHERE id = $1 "
+                "RETURNING last_seq",
+                chat_id,
+            )
+            if seq is None:
+                raise ObjectNotFound()
             res = await insert_with_unique_id(
                 "messages",
-                ("chat_attached_id", "author_id", "tag_list", "body", "has_attached_file"),
-                (chat_id, current_user, tags, body, has_attached_file),
+                ("chat_attached_id", "seq", "author_id", "tag_list", "body", "has_attached_file"),
+                (chat_id, seq, current_user, tags, body, has_attached_file),
+                con=con,
+            )
+            # The sender has read their own message
+            await con.execute(
+                "UPDATE chat_participants SET last_read_seq = $3 WHERE chat_id = $1 AND participant_id = $2",
+                chat_id, current_user, seq,
             )
             if attachments:
                 for a in attachments:
                     await insert_without_unique_id(
-                        "message_attachments", ("chat_attached_id", "message_attached_id", "uri"), (chat_id, res, a)
+                        "message_attachments", ("chat_attached_id", "message_attached_id", "uri"), (chat_id, res, a),
+                        con=con,
                     )
     return await __get_message__(res, True)
 
@@ -387,16 +496,11 @@ async def __send_message__(
 async def __send_message_desktop__(
         current_user: int,
         chat_info: Dict[str, Any],
-        message: Dict[str, Any],
+        frame: Frame,
 ):
     for chat_user in chat_info["users"]:
-        # for i in range(1, 100):
-        ws = connections.active_connections.get(chat_user)
-        # ws = connections.active_connections.get(i)
-        if ws is not None and ws is not current_user:
-            log.info(f'Websocket send message to {ws}')
-            log.info("  body: " + message["body"])
-            await ws.send_bytes(json.dumps({**message}, indent=4, sort_keys=True, default=str))
+        if chat_user in connections.active_connections:
+            connections.send_to_user(chat_user, frame)
 
 
 @db_required
@@ -406,18 +510,15 @@ async def __send_message_firebase__(
         message: Dict[str, Any],
         user_nick: str,
 ):
-    token_list = await extract_tokens(current_user=current_user, users=chat_info["users"])
-    # log.info(token_list)
-    message_firebase = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title=chat_info["name"],
-            body=user_nick + ": " + message["body"],
-        ),
-        data={'data': json.dumps({**message}, indent=4, sort_keys=True, default=str)},
-        tokens=token_list
-    )
-    response = messaging.send_multicast(message_firebase)
-    # print('Successfully sent message:', response)
+    token_list = await extract_tokens(current_user=current_user, users=chat_info["users"], chat_id=chat_info["id"])
+    if not token_list:
+        return
+    push_gateway.enqueue(PushNotification(
+        title=chat_info["name"],
+        body=user_nick + ": " + message["body"],
+        data={'data': Frame({**message}).json},
+        tokens=token_list,
+    ))
 
 
 @db_required
@@ -429,6 +530,37 @@ async def send_system_message(
     return message
 
 
+@db_required
+async def __deliver_message__(current_user: int, message: Dict[str, Any]):
+    user_info = await get_identity(current_user)
+    chat_info = await get_info(current_user=current_user, chat_id=message["chat_attached_id"])
+
+    # Every process pushes the message to the websockets it holds
+    await delivery_bus.publish("message", m=message["id"], c=message["chat_attached_id"], s=message["seq"])
+
+    # Send message to android client
+    await __send_message_firebase__(current_user=current_user, chat_info=chat_info, message=message,
+                                    user_nick=user_info["nick"])
+
+
+async def __on_message_event__(event: Dict[str, Any]) -> None:
+    if "s" in event:
+        # Noted even when nobody here needs the message, so the replay buffer knows what it is missing
+        replay_buffer.advance(event["c"], event["s"])
+    try:
+        chat_info = await get_info(current_user=1, chat_id=event["c"])
+        if not any(user in connections.active_connections for user in chat_info["users"]):
+            return
+        message = await __get_message__(event["m"])
+    except ObjectNotFound:
+        # Deleted before this process got to it
+        return
+    message.update({"message_type": "message"})
+    frame = Frame({**message})
+    replay_buffer.record(message["chat_attached_id"], message["seq"], frame)
+    await __send_message_desktop__(current_user=message["author_id"], chat_info=chat_info, frame=frame)
+
+
 @db_required
 async def send_message(
         current_user: int,
@@ -437,32 +569,25 @@ async def send_message(
         attachments: Optional[List[int]] = None,
         tags: Optional[List[str]] = None,
 ) -> Dict[str, Any]:
-    user_info = await get_user_info(user_id=current_user)
-
     message = await __send_message__(current_user=current_user, chat_id=chat_id, body=body, attachments=attachments,
                                      tags=tags)
     message.update({"message_type": "message"})
 
-    chat_info = await get_info(current_user=current_user, chat_id=chat_id)
-
-    # Send message to desktop client
-    await __send_message_desktop__(current_user=current_user, chat_info=chat_info, message=message)
-
-    # Send message to android client
-    await __send_message_firebase__(current_user=current_user, chat_info=chat_info, message=message,
-                                    user_nick=user_info["nick"])
+    # Delivery runs in the fan-out stage, the sender only waits for the commit
+    await fanout.submit(lambda: __deliver_message__(current_user=current_user, message=message), key=chat_id,
+                        label=f"delivery of message {message['id']}")
     return message
 
 
 @db_required
-async def get_attachment(file_uri: str, chat_id: int, current_user: int):
-    if file_path := await config.db.fetchrow(f'select path_original from sources where inner_uri = $1 limit 1;',
-                                             file_uri):
-        if bool(await config.db.fetchrow(
+async def get_attachment(file_uri: str, chat_id: int, current_user: int) -> Dict[str, Any]:
+    if source := await config.db.fetchrow(
+            'select inner_uri, path_original, content_hash from sources where inner_uri = $1 limit 1;', file_uri):
+        if await config.db.fetchval(
                 f'select exists(select chat_id from chat_attachments '
-                f'where chat_id = $1 and attachment = $2 limit 1);', chat_id, file_uri)) and await \
+                f'where chat_id = $1 and attachment = $2 limit 1);', chat_id, file_uri) and await \
                 has_user(user_id=current_user, chat_id=chat_id):
-            return file_path["path_original"]
+            return dict(source)
         raise PermissionDenied()
     raise ObjectNotFound()
 
@@ -470,19 +595,34 @@ async def get_attachment(file_uri: str, chat_id: int, current_user: int):
 @db_required
 async def create_upload_file(uploaded_files: List[UploadFile], current_user: int, description: str,
                              is_showable: bool, is_public: bool = True) -> List[str]:
-    file_ids = []
-    for uploaded_file in uploaded_files:
-        filename, file_extension = os.path.splitext(uploaded_file.filename)
-        file_id = str(uuid.uuid4()) + file_extension
-        file_location = os.path.join(os.path.dirname(__file__), f'attachments/{file_id}')
-        with open(file_location, "wb+") as file_object:
-            shutil.copyfileobj(uploaded_file.file, file_object)
-        await insert_without_unique_id("sources",
-                                       ("inner_uri", "is_public", "is_showable", "path_original",
-                                        "path_thumbnail", "owner", "description", "meta"),
-                                       (file_id, is_public, is_showable, file_location, file_location,
-                                        current_user, description, "meta"))
-        file_ids.append(file_id)
+    stored = await asyncio.gather(*(store_blob(uploaded_file) for uploaded_file in uploaded_files))
+    file_ids = [str(uuid.uuid4()) + os.path.splitext(uploaded_file.filename)[1] for uploaded_file in uploaded_files]
+    blobs = {content_hash: (size, path) for content_hash, size, path, _ in stored}
+    try:
+        async with config.db.acquire() as con:
+            async with con.transaction():
+                await con.execute(
+                    "INSERT INTO blobs (hash, size, path) "
+                    "SELECT * FROM unnest($1::varchar[], $2::int8[], $3::varchar[]) ON CONFLICT (hash) DO NOTHING;",
+                    list(blobs), [size for size, _ in blobs.values()], [path for _, path in blobs.values()],
+                )
+                # One statement for the whole upload; blobs.ref_count is kept by a trigger on sources
+                await con.execute(
+                    "INSERT INTO sources (inner_uri, content_hash, path_original, is_public, is_showable, owner, "
+                    "description, meta) "
+                    "SELECT uri, hash, path, $4, $5, $6, $7, 'meta' "
+                    "FROM unnest($1::varchar[], $2::varchar[], $3::varchar[]) AS files(uri, hash, path);",
+                    file_ids, [content_hash for content_hash, *_ in stored], [path for _, _, path, _ in stored],
+                    is_public, is_showable, current_user, description,
+                )
+    except BaseException:
+        # Nothing refers to the files this upload put on disk
+        await discard_new_blobs(stored)
+        raise
+    # Previews are rendered in the background, the uploader only waits for the originals
+    for file_id, (content_hash, _, path, _) in zip(file_ids, stored):
+        if is_image(file_id):
+            thumbnail_pool.enqueue(content_hash, path)
     return file_ids
 
 
@@ -532,6 +672,7 @@ async def edit_message(
             #             "message_tags", ("message_id", "tag"), (message_id, t)
             #         )
     m = await __get_message__(message_id)
+    await __message_changed__(m["chat_attached_id"], m["seq"])
     return m
 
 
@@ -543,6 +684,7 @@ async def delete_message(current_user: int, message_id: int) -> bool:
         # or c["non_removable_messages"]
         raise PermissionDenied()
     await config.db.execute("DELETE FROM messages WHERE id=$1", message_id)
+    await __message_changed__(m["chat_attached_id"], m["seq"])
     return True
 
 
@@ -557,44 +699,216 @@ async def get_chats_for_user(user_id: str) -> List[str]:
     raise ObjectNotFound()
 
 
+MESSAGE_CHANGES = ("message_created", "message_edited")
+
+# Entries of the user's chats plus those addressed to them (they were removed), each chat read through its index
+SYNC_QUERY = """
+select changes.*, to_jsonb(m) - 'body_search' as message from (
+    (select c.* from chat_participants p
+     cross join lateral (
+         select * from chat_changes c
+         where c.chat_id = p.chat_id and (c.txid, c.id) > ($2, $3) and c.txid < $4
+         order by c.txid, c.id limit $5
+     ) c
+     where p.participant_id = $1)
+    union
+    (select * from chat_changes c
+     where c.target_user = $1 and (c.txid, c.id) > ($2, $3) and c.txid < $4
+     order by c.txid, c.id limit $5)
+) changes
+left join messages m on m.id = changes.object_id and changes.kind = any($6::varchar[])
+order by changes.txid, changes.id
+limit $5;
+"""
+
+
+@db_required
+async def sync(current_user: int, since: Optional[str] = None, limit: int = 200) -> Dict[str, Any]:
+    # Entries of transactions older than every running one are final, the rest wait for the next call
+    horizon = await config.db.fetchval("select txid_snapshot_xmin(txid_current_snapshot());")
+    if since is None:
+        return {"changes": [], "next": encode_cursor(horizon, 0), "has_more": False}
+    txid, change_id = decode_cursor(since, (int, int))
+    records = await config.db.fetch(SYNC_QUERY, current_user, txid, change_id, horizon, limit + 1,
+                                    MESSAGE_CHANGES)
+    has_more = len(records) > limit
+    records = records[:limit]
+    changes = [
+        {
+            "chat_id": record["chat_id"],
+            "kind": record["kind"],
+            "object_id": record["object_id"],
+            "data": json.loads(record["data"]) if record["data"] else None,
+            "message": json.loads(record["message"]) if record["message"] else None,
+            "time": record["created_at"],
+        }
+        for record in records
+    ]
+    # Everything settled before the horizon has been read once the last page is out
+    if has_more:
+        next_token = encode_cursor(records[-1]["txid"], records[-1]["id"])
+    else:
+        next_token = encode_cursor(*max((txid, change_id), (horizon, 0)))
+    return {"changes": changes, "next": next_token, "has_more": has_more}
+
+
+INBOX_QUERY = """
+select c.id, c.name, c.avatar, c.color_rgba, c.encoded, c.last_activity, c.last_seq, p.last_read_seq,
+       greatest(c.last_seq - p.last_read_seq, 0) as unread,
+       (select count(*) from chat_participants where chat_id = c.id) as members,
+       m.id as last_message_id, m.author_id as last_message_author, m.sent_time as last_message_time,
+       left(m.body, $5) as last_message_preview, m.has_attached_file as last_message_has_attachment
+from chat_participants p
+join chats c on c.id = p.chat_id
+left join lateral (
+    select * from messages
+    where chat_attached_id = c.id and seq <= c.last_seq
+    order by seq desc
+    limit 1
+) m on true
+where p.participant_id = $1 and ($2::timestamptz is null or (c.last_activity, c.id) < ($2, $3))
+order by c.last_activity desc, c.id desc
+limit $4;
+"""
+
+
+def inbox_cursor(chat: Dict[str, Any]) -> str:
+    return encode_cursor(chat["last_activity"].isoformat(), chat["id"])
+
+
+@db_required
+async def get_inbox(current_user: int, limit: int = 20, before: Optional[str] = None,
+                    preview_length: int = 100) -> List[Dict[str, Any]]:
+    last_activity, chat_id = None, None
+    if before:
+        last_activity, chat_id = decode_cursor(before, (str, int))
+        try:
+            last_activity = datetime.fromisoformat(last_activity)
+        except (TypeError, ValueError):
+            raise InvalidRange()
+    return [dict(record) for record in
+            await config.db.fetch(INBOX_QUERY, current_user, last_activity, chat_id, limit, preview_length)]
+
+
+@db_required
+async def mark_read(current_user: int, chat_id: int, seq: int) -> bool:
+    if not await has_user(current_user, chat_id):
+        raise PermissionDenied()
+    # Cursors only move forward and never past the last message
+    await config.db.execute(
+        "UPDATE chat_participants p SET last_read_seq = least($3, c.last_seq) FROM chats c "
+        "WHERE c.id = p.chat_id AND p.chat_id = $1 AND p.participant_id = $2 "
+        "AND p.last_read_seq < least($3, c.last_seq)",
+        chat_id, current_user, seq,
+    )
+    return True
+
+
 @db_required
-async def get_personal_chat(user1: int, user2: int) -> Optional[str]:
-    chat_list = await get_chats_for_user(user1)
-    for chat_id in chat_list:
-        chat = await __get_info__(chat_id)
-        if chat["is_personal"] and await has_user(user2, chat_id):
-            return chat_id
-    return None
+async def get_personal_chat(user1: int, user2: int) -> Optional[int]:
+    return await config.db.fetchval(
+        "SELECT chat_id FROM personal_chats WHERE user_low = $1 AND user_high = $2;", *__personal_pair__(user1, user2)
+    )
+
+
+@db_required
+async def __is_personal__(chat_id: int) -> bool:
+    return await config.db.fetchval("SELECT exists(SELECT FROM personal_chats WHERE chat_id = $1);", chat_id)
+
+
+# Ranks and pages over the matches first, snippets are only cut for the page that is returned
+SEARCH_QUERY = """
+select page.id, page.chat_attached_id, page.seq, page.author_id, page.sent_time, page.tag_list,
+       page.has_attached_file, page.rank,
+       ts_headline('simple', m.body, page.query, 'StartSel=<b>, StopSel=</b>, MaxFragments=2') as snippet
+from (
+    select m.id, m.chat_attached_id, m.seq, m.author_id, m.sent_time, m.tag_list, m.has_attached_file,
+           ts_rank(m.body_search, query) as rank, query
+    from websearch_to_tsquery('simple', $2) query, messages m
+    join chat_participants p on p.chat_id = m.chat_attached_id and p.participant_id = $1
+    where m.body_search @@ query
+      and ($3::int8 is null or m.chat_attached_id = $3)
+      and ($4::float4 is null or (ts_rank(m.body_search, query), m.id) < ($4::float4, $5::int8))
+    order by rank desc, m.id desc
+    limit $6
+) page
+join messages m on m.id = page.id
+order by page.rank desc, page.id desc;
+"""
+
+
+def search_cursor(result: Dict[str, Any]) -> str:
+    return encode_cursor(result["rank"], result["id"])
+
+
+@db_required
+async def search_messages(current_user: int, query: str, chat_id: Optional[int] = None, limit: int = 20,
+                          after: Optional[str] = None) -> List[Dict[str, Any]]:
+    if not query.strip():
+        raise InvalidRange()
+    rank, message_id = decode_cursor(after, (float, int)) if after else (None, None)
+    return [dict(record) for record in
+            await config.db.fetch(SEARCH_QUERY, current_user, query, chat_id, rank, message_id, limit)]
+
+
+TAG_MATCH = {"all": "@>", "any": "&&"}
 
 
 @db_required
 async def get_messages_with_tag(
-        current_user: int, chat_id: int, tag: str
+        current_user: int, chat_id: int, tags: List[str], match: str = "all", limit: int = 50,
+        before: Optional[str] = None,
 ) -> List[Dict[str, Any]]:
+    if match not in TAG_MATCH or not tags:
+        raise InvalidRange()
     if not await has_user(current_user, chat_id):
         raise PermissionDenied()
-    if message_list := await config.db.fetch(
-            "select * from messages where chat_attached_id = $1 and $2 = any(tag_list) ",
-            chat_id,
-            tag,
-    ):
+    seq = decode_cursor(before, (int,))[0] if before else None
+    # Containment over (chat_attached_id, tag_list) is answered by the messages_chat_tags_ind GIN index
+    message_list = await config.db.fetch(
+        f"select {MESSAGE_COLUMNS} from messages "
+        f"where chat_attached_id = $1 and tag_list {TAG_MATCH[match]} $2::varchar[] "
+        f"and ($3::int8 is null or seq < $3) order by seq desc limit $4;",
+        chat_id,
+        tags,
+        seq,
+        limit,
+    )
+    if message_list or before:
         return message_list
     raise ObjectNotFound()
 
 
 @db_required
-async def extract_tokens(current_user: int, users: List[int]):
-    token_list = []
-    for user in users:
-        if user != current_user:
-            # log.info(user)
-            if token := await config.db.fetchrow(
-                    "select devices_token_list as tokens from users_authentication where id = $1 limit 1;",
-                    user
-            ):
-                # logging.info(token)
-                # logging.info(token["tokens"])
-                token_list.extend(token["tokens"])
-    if token_list is not None:
-        return token_list
-    raise ObjectNotFound()
+async def get_tag_counts(current_user: int, chat_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+    if not await has_user(current_user, chat_id):
+        raise PermissionDenied()
+    return [dict(record) for record in await config.db.fetch(
+        "select tag, count from chat_tag_counts where chat_id = $1 order by count desc, tag limit $2;",
+        chat_id,
+        limit,
+    )]
+
+
+@db_required
+async def extract_tokens(current_user: int, users: List[int], chat_id: Optional[int] = None) -> List[str]:
+    tokens_by_user = chat_tokens_cache.get_tokens(chat_id, users) if chat_id is not None else None
+    if tokens_by_user is None:
+        tokens_by_user = {
+            record["user_id"]: record["tokens"]
+            for record in await config.db.fetch(
+                "select user_id, array_agg(token) as tokens from device_tokens "
+                "where user_id = any($1::int8[]) group by user_id;",
+                users,
+            )
+        }
+        if chat_id is not None:
+            chat_tokens_cache.put_tokens(chat_id, users, tokens_by_user)
+    return list(dict.fromkeys(
+        token for user, tokens in tokens_by_user.items() if user != current_user for token in tokens or ()
+    ))
+
+
+delivery_bus.on("message", __on_message_event__)
+delivery_bus.on("message_changed", __on_message_changed_event__)
+delivery_bus.on("chat", __on_chat_event__)
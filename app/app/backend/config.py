@@ -1 +1,4 @@
+from app.app.settings import Settings
+
 db = None
+settings = Settings()
@@ -24,3 +24,7 @@ class ObjectNotFound(Exception):
 
 class InvalidRange(Exception):
     pass
+
+
+class Overloaded(Exception):
+    pass
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List
+
+from app.app.backend import config
+
+log = logging.getLogger(__name__)
+
+BLOCK = "block"
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"
+
+
+class FanOut:
+    """
+    In-process delivery stage. Jobs are queued by the request handler and run
+    by a fixed pool of worker tasks, so the client only waits for the commit.
+    Every worker has its own queue and jobs are sharded by `key` (the chat
+    id), so the deliveries of one chat run one at a time, in order.
+    Jobs do not wait on recipients: websocket frames go through the bounded
+    outbound queue of each connection, which has its own send timeout. When
+    a queue is full the producer waits up to `timeout` for room and the job
+    is dropped after that, or with `overflow` set to a drop policy the newest
+    or the oldest job is dropped right away. Every drop is logged with the
+    label of the job.
+    """
+
+    def __init__(self, queue_size: int = 10000, workers: int = 8, overflow: str = BLOCK, timeout: float = 1.0):
+        if overflow not in (BLOCK, DROP_NEWEST, DROP_OLDEST):
+            raise ValueError(f"Unknown overflow policy '{overflow}'")
+        self.queue_size = queue_size
+        self.workers = workers
+        self.overflow = overflow
+        self.timeout = timeout
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue(maxsize=max(1, self.queue_size // self.workers)) for _ in range(self.workers)]
+        self._tasks = [asyncio.ensure_future(self._worker(queue)) for queue in self._queues]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, job: Callable[[], Awaitable[Any]], key: int = 0, label: str = "delivery job") -> bool:
+        self.start()
+        queue = self._queues[key % self.workers]
+        if self.overflow == BLOCK and queue.full():
+            try:
+                await asyncio.wait_for(queue.put((job, label)), self.timeout)
+                return True
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                log.warning(f"Fan-out queue is full for {self.timeout}s, dropping {label}")
+                return False
+        if queue.full():
+            self.dropped += 1
+            if self.overflow == DROP_NEWEST:
+                log.warning(f"Fan-out queue is full, dropping {label}")
+                return False
+            _, oldest = queue.get_nowait()
+            queue.task_done()
+            log.warning(f"Fan-out queue is full, dropping {oldest}")
+        queue.put_nowait((job, label))
+        return True
+
+    async def join(self) -> None:
+        for queue in self._queues:
+            await queue.join()
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            job, label = await queue.get()
+            try:
+                await job()
+                self.completed += 1
+            except Exception:
+                self.failed += 1
+                log.exception(f"{label.capitalize()} failed")
+            finally:
+                queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": sum(queue.qsize() for queue in self._queues),
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+fanout = FanOut(queue_size=config.settings.fanout_queue_size,
+                workers=config.settings.fanout_workers,
+                overflow=config.settings.fanout_overflow,
+                timeout=config.settings.fanout_submit_timeout)
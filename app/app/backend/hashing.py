@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from passlib.hash import pbkdf2_sha256
+
+from app.app.backend import config
+from app.app.backend.exceptions import Overloaded
+
+log = logging.getLogger(__name__)
+
+
+def _timed_hash(password: str, submitted: float):
+    started = time.time()
+    return pbkdf2_sha256.hash(password), started - submitted, time.time() - started
+
+
+def _timed_verify(password: str, password_hash: str, submitted: float):
+    started = time.time()
+    return pbkdf2_sha256.verify(password, password_hash), started - submitted, time.time() - started
+
+
+class HashingPool:
+    """
+    Runs password hashing in a dedicated thread or process pool. At most
+    `workers + queue_size` jobs are admitted at once, the rest are rejected
+    with Overloaded instead of piling up behind the event loop.
+    """
+
+    def __init__(self, kind: str, workers: int, queue_size: int):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown hash executor kind '{kind}'")
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hashing")
+        return self._executor
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        if self.in_flight >= self.workers + self.queue_size:
+            self.rejected += 1
+            log.warning(f"Hashing pool saturated ({self.in_flight} jobs), rejecting request")
+            raise Overloaded()
+        self.in_flight += 1
+        try:
+            result, queue_wait, hash_time = await asyncio.get_event_loop().run_in_executor(
+                self._get_executor(), func, *args, time.time()
+            )
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.hash_time_total += hash_time
+        self.hash_time_max = max(self.hash_time_max, hash_time)
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_avg": self.queue_wait_total / self.completed if self.completed else None,
+            "queue_wait_max": self.queue_wait_max,
+            "hash_time_avg": self.hash_time_total / self.completed if self.completed else None,
+            "hash_time_max": self.hash_time_max,
+        }
+
+
+hashing_pool = HashingPool(config.settings.hash_executor, config.settings.hash_workers,
+                           config.settings.hash_queue_size)
+
+
+async def hash_password(password: str) -> str:
+    return await hashing_pool.run(_timed_hash, password)
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    return await hashing_pool.run(_timed_verify, password, password_hash)
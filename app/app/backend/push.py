@@ -0,0 +1,211 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from firebase_admin import exceptions as firebase_exceptions
+from firebase_admin import messaging
+
+from app.app.backend import config
+from app.app.backend.user import remove_fcm_tokens
+
+log = logging.getLogger(__name__)
+
+MULTICAST_LIMIT = 500
+
+DEAD = "dead"
+RETRY = "retry"
+FAILED = "failed"
+
+
+@dataclass
+class PushNotification:
+    title: str
+    body: str
+    data: Dict[str, str]
+    tokens: List[str]
+    attempt: int = 0
+
+
+class FirebaseTransport:
+    """Sends multicast messages through the blocking firebase_admin SDK."""
+
+    def send(self, notification: PushNotification) -> List[Optional[Exception]]:
+        send_multicast = getattr(messaging, "send_each_for_multicast", None) or messaging.send_multicast
+        response = send_multicast(messaging.MulticastMessage(
+            notification=messaging.Notification(title=notification.title, body=notification.body),
+            data=notification.data,
+            tokens=notification.tokens,
+        ))
+        return [None if r.success else r.exception for r in response.responses]
+
+    @staticmethod
+    def classify(error: Exception) -> str:
+        if isinstance(error, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+            return DEAD
+        if isinstance(error, (firebase_exceptions.UnavailableError, firebase_exceptions.InternalError,
+                              firebase_exceptions.DeadlineExceededError, messaging.QuotaExceededError)):
+            return RETRY
+        return FAILED
+
+
+class FakeTransport:
+    """
+    Offline transport for tests. Every call is recorded in `sent`; tokens
+    listed in `dead_tokens` fail as unregistered and `failures` makes the
+    next calls raise before anything is delivered.
+    """
+
+    class Unregistered(Exception):
+        pass
+
+    class Unavailable(Exception):
+        pass
+
+    def __init__(self, dead_tokens: Optional[List[str]] = None, failures: int = 0):
+        self.sent: List[PushNotification] = []
+        self.dead_tokens = set(dead_tokens or [])
+        self.failures = failures
+
+    def send(self, notification: PushNotification) -> List[Optional[Exception]]:
+        if self.failures:
+            self.failures -= 1
+            raise self.Unavailable()
+        self.sent.append(notification)
+        return [self.Unregistered() if t in self.dead_tokens else None for t in notification.tokens]
+
+    @classmethod
+    def classify(cls, error: Exception) -> str:
+        if isinstance(error, cls.Unregistered):
+            return DEAD
+        if isinstance(error, cls.Unavailable):
+            return RETRY
+        return FAILED
+
+
+class PushGateway:
+    """
+    Delivers push notifications off the request path. Notifications are put
+    on a bounded queue, split into multicast chunks and sent from a thread
+    pool by a fixed number of worker tasks. Failed calls are retried with
+    exponential backoff and tokens reported as unregistered are pruned.
+    """
+
+    def __init__(self, transport: Any = None, queue_size: int = 10000, workers: int = 4, threads: int = 8,
+                 max_retries: int = 3, retry_backoff: float = 0.5,
+                 on_dead_tokens: Callable[[List[str]], Awaitable[Any]] = remove_fcm_tokens):
+        self.transport = transport or FirebaseTransport()
+        self.queue_size = queue_size
+        self.workers = workers
+        self.threads = threads
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.on_dead_tokens = on_dead_tokens
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.pruned = 0
+        self.retried = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="push")
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def enqueue(self, notification: PushNotification) -> bool:
+        if not notification.tokens:
+            return False
+        self.start()
+        for start in range(0, len(notification.tokens), MULTICAST_LIMIT):
+            chunk = PushNotification(notification.title, notification.body, notification.data,
+                                     notification.tokens[start:start + MULTICAST_LIMIT])
+            try:
+                self._queue.put_nowait(chunk)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                log.warning("Push queue is full, dropping notification")
+                return False
+        return True
+
+    async def join(self) -> None:
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _worker(self) -> None:
+        while True:
+            notification = await self._queue.get()
+            try:
+                await self._deliver(notification)
+            except Exception:
+                log.exception("Push delivery failed")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, notification: PushNotification) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                results = await loop.run_in_executor(self._executor, self.transport.send, notification)
+            except Exception as e:
+                if self.transport.classify(e) != RETRY or notification.attempt >= self.max_retries:
+                    self.failed += len(notification.tokens)
+                    log.warning(f"Push of {len(notification.tokens)} tokens failed: {e!r}")
+                    return
+                notification = await self._backoff(notification, notification.tokens)
+                continue
+            dead, retry = [], []
+            for token, error in zip(notification.tokens, results):
+                if error is None:
+                    self.sent += 1
+                    continue
+                kind = self.transport.classify(error)
+                if kind == DEAD:
+                    dead.append(token)
+                elif kind == RETRY and notification.attempt < self.max_retries:
+                    retry.append(token)
+                else:
+                    self.failed += 1
+            if dead:
+                self.pruned += len(dead)
+                await self.on_dead_tokens(dead)
+            if not retry:
+                return
+            notification = await self._backoff(notification, retry)
+
+    async def _backoff(self, notification: PushNotification, tokens: List[str]) -> PushNotification:
+        self.retried += 1
+        await asyncio.sleep(self.retry_backoff * 2 ** notification.attempt)
+        return PushNotification(notification.title, notification.body, notification.data, tokens,
+                                notification.attempt + 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "pruned": self.pruned,
+            "retried": self.retried,
+        }
+
+
+push_gateway = PushGateway(queue_size=config.settings.push_queue_size,
+                           workers=config.settings.push_workers,
+                           threads=config.settings.push_threads,
+                           max_retries=config.settings.push_max_retries,
+                           retry_backoff=config.settings.push_retry_backoff)
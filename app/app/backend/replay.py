@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from app.app.backend import config
+
+
+class _Ring:
+    __slots__ = ("head", "frames")
+
+    def __init__(self):
+        self.head = 0
+        self.frames: "OrderedDict[int, Any]" = OrderedDict()
+
+
+class ReplayBuffer:
+    """
+    Recent message frames of each chat keyed by seq, so reconnecting clients
+    can catch up from memory. `head` is the newest seq announced for a chat
+    whether or not its frame was kept here; any hole between the client's
+    position and the head means the caller has to go to the database.
+    """
+
+    def __init__(self, chats: int = 10000, size: int = 128):
+        self.chats = chats
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._rings: "OrderedDict[int, _Ring]" = OrderedDict()
+
+    def _ring(self, chat_id: int) -> _Ring:
+        if (ring := self._rings.get(chat_id)) is None:
+            ring = self._rings[chat_id] = _Ring()
+            while len(self._rings) > self.chats:
+                self._rings.popitem(last=False)
+        self._rings.move_to_end(chat_id)
+        return ring
+
+    def advance(self, chat_id: int, seq: int) -> None:
+        ring = self._ring(chat_id)
+        ring.head = max(ring.head, seq)
+
+    def record(self, chat_id: int, seq: int, frame: Any) -> None:
+        ring = self._ring(chat_id)
+        ring.head = max(ring.head, seq)
+        ring.frames[seq] = frame
+        while len(ring.frames) > self.size:
+            ring.frames.popitem(last=False)
+
+    def evict(self, chat_id: int, seq: int) -> None:
+        """Forget the frame of an edited or deleted message, it is read from the database again."""
+        if (ring := self._rings.get(chat_id)) is not None:
+            ring.frames.pop(seq, None)
+
+    def since(self, chat_id: int, seq: int, head: int = 0) -> Optional[List[Any]]:
+        """
+        Frames after `seq` in order, or None when they are not all in memory.
+        `head` is the last seq committed for the chat: events this process
+        never got (a full queue, a lost listening connection) leave the ring
+        behind it, and then the frames up to it cannot be in memory.
+        """
+        ring = self._rings.get(chat_id)
+        if ring is not None and head > ring.head:
+            ring.head = head
+        if ring is None or ring.head - seq > self.size:
+            self.misses += 1
+            return None
+        missed = range(seq + 1, ring.head + 1)
+        if any(s not in ring.frames for s in missed):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [ring.frames[s] for s in missed]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "chats": len(self._rings),
+            "frames": sum(len(ring.frames) for ring in self._rings.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+replay_buffer = ReplayBuffer(config.settings.replay_chats, config.settings.replay_ring_size)
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import UploadFile
+
+from app.app.backend import config
+from app.app.backend.utils import db_required
+
+ATTACHMENTS_DIR = config.settings.attachments_dir or os.path.join(os.path.dirname(__file__), "attachments")
+
+# Disk writes of uploads never run on the event loop
+executor = ThreadPoolExecutor(max_workers=config.settings.upload_threads, thread_name_prefix="upload")
+
+
+def blob_path(content_hash: str, directory: str = ATTACHMENTS_DIR) -> str:
+    return os.path.join(directory, content_hash[:2], content_hash)
+
+
+def _open_temp(directory: str) -> Tuple[object, str]:
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+    return os.fdopen(fd, "wb"), path
+
+
+def _write_chunk(file, hasher, chunk: bytes) -> None:
+    hasher.update(chunk)
+    file.write(chunk)
+
+
+def _settle(temp_path: str, path: str) -> bool:
+    """Move a finished upload into place, or drop it when the same content is already stored."""
+    if os.path.exists(path):
+        os.remove(temp_path)
+        # Fresh again, sweep_blobs leaves the file alone even if its old row goes
+        os.utime(path)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+    return True
+
+
+def _discard(file, path: str) -> None:
+    file.close()
+    os.remove(path)
+
+
+async def store_blob(upload: UploadFile, directory: str = ATTACHMENTS_DIR,
+                     chunk_size: Optional[int] = None) -> Tuple[str, int, str, bool]:
+    """
+    Stream an upload to disk chunk by chunk, hashing it with SHA-256 on the
+    way, and store it under its hash. Returns the hash, the size and the
+    path of the stored content, and whether this upload created the file.
+    """
+    loop = asyncio.get_event_loop()
+    chunk_size = chunk_size or config.settings.upload_chunk_size
+    file, temp_path = await loop.run_in_executor(executor, _open_temp, directory)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        while chunk := await upload.read(chunk_size):
+            await loop.run_in_executor(executor, _write_chunk, file, hasher, chunk)
+            size += len(chunk)
+        await loop.run_in_executor(executor, file.close)
+    except BaseException:
+        await loop.run_in_executor(executor, _discard, file, temp_path)
+        raise
+    content_hash = hasher.hexdigest()
+    path = blob_path(content_hash, directory)
+    created = await loop.run_in_executor(executor, _settle, temp_path, path)
+    return content_hash, size, path, created
+
+
+def _remove(paths: List[str], not_after: Optional[float] = None) -> None:
+    for path in paths:
+        try:
+            if not_after is None or os.path.getmtime(path) <= not_after:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+@db_required
+async def discard_new_blobs(stored: List[Tuple[str, int, str, bool]]) -> None:
+    """
+    Remove the files an upload created when its sources could not be
+    committed. Files that a blob row points at by now are kept, another
+    upload of the same content got to commit.
+    """
+    created = {content_hash: path for content_hash, _, path, new in stored if new}
+    if not created:
+        return
+    recorded = {record["hash"] for record in
+                await config.db.fetch("SELECT hash FROM blobs WHERE hash = any($1::varchar[]);", list(created))}
+    await asyncio.get_event_loop().run_in_executor(
+        executor, _remove, [path for content_hash, path in created.items() if content_hash not in recorded])
+
+
+@db_required
+async def sweep_blobs(min_age: float) -> int:
+    """
+    Delete the blobs no source uses any more (ref_count = 0) that are older
+    than `min_age` seconds, with their files and previews. A file uploaded
+    again since the cutoff is kept; the new upload records its row again.
+    Returns the number of blobs deleted.
+    """
+    cutoff = time.time() - min_age
+    swept = await config.db.fetch(
+        "DELETE FROM blobs b WHERE ref_count = 0 AND created_at < to_timestamp($1) "
+        "RETURNING path, array(SELECT t.path FROM thumbnails t WHERE t.content_hash = b.hash) AS previews;",
+        cutoff,
+    )
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(executor, _remove, [record["path"] for record in swept], cutoff)
+    await loop.run_in_executor(executor, _remove, [path for record in swept for path in record["previews"]])
+    return len(swept)
+
+
+def _hash_file(path: str, chunk_size: int) -> Tuple[str, int]:
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+@db_required
+async def content_hash_of(source: Dict[str, Any]) -> str:
+    """
+    Hash of the content of a source. Sources uploaded before content
+    addressing have none; their file is hashed on first use and recorded
+    as a blob at its current path.
+    """
+    if source["content_hash"]:
+        return source["content_hash"]
+    loop = asyncio.get_event_loop()
+    content_hash, size = await loop.run_in_executor(executor, _hash_file, source["path_original"],
+                                                    config.settings.upload_chunk_size)
+    async with config.db.acquire() as con:
+        async with con.transaction():
+            await con.execute("INSERT INTO blobs (hash, size, path) VALUES ($1, $2, $3) ON CONFLICT (hash) DO NOTHING;",
+                              content_hash, size, source["path_original"])
+            await con.execute("UPDATE sources SET content_hash = $1 WHERE inner_uri = $2 AND content_hash IS NULL;",
+                              content_hash, source["inner_uri"])
+    return content_hash
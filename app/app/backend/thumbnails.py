@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import mimetypes
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is optional, without it attachments are served without previews
+    Image = None
+
+from app.app.backend import config
+from app.app.backend.storage import ATTACHMENTS_DIR
+from app.app.backend.utils import db_required
+
+log = logging.getLogger(__name__)
+
+THUMBNAILS_DIR = config.settings.thumbnails_dir or os.path.join(ATTACHMENTS_DIR, "thumbnails")
+
+# Formats Pillow decodes; anything else (svg, heic, ...) is served as is
+IMAGE_TYPES = {"image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff"}
+
+Preview = Tuple[int, str, int, int, int]
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def is_image(filename: str) -> bool:
+    return mimetypes.guess_type(filename)[0] in IMAGE_TYPES
+
+
+def preview_format() -> Tuple[str, str]:
+    return ("WEBP", ".webp") if features.check("webp") else ("JPEG", ".jpg")
+
+
+def preview_path(content_hash: str, size: int, extension: str, directory: str = THUMBNAILS_DIR) -> str:
+    return os.path.join(directory, content_hash[:2], f"{content_hash}-{size}{extension}")
+
+
+def render_previews(path: str, content_hash: str, sizes: List[int], directory: str = THUMBNAILS_DIR,
+                    quality: int = 70) -> List[Preview]:
+    """
+    Decode an image once and write a preview for every size, each fitting a
+    size x size box. Runs in a worker process. Returns (size, path, bytes,
+    width, height) of every preview.
+    """
+    image_format, extension = preview_format()
+    previews = []
+    with Image.open(path) as image:
+        # Lets the JPEG decoder scale down by a power of two while decoding
+        image.draft("RGB", (max(sizes), max(sizes)))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image_format == "WEBP" and ("A" in image.getbands() or "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        # Largest first, every size is resampled from the previous one instead of the original
+        for size in sorted(set(sizes), reverse=True):
+            image.thumbnail((size, size), Image.LANCZOS)
+            target = preview_path(content_hash, size, extension, directory)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".preview-")
+            with os.fdopen(fd, "wb") as file:
+                image.save(file, image_format, quality=quality, optimize=True)
+            os.replace(temp_path, target)
+            previews.append((size, target, os.path.getsize(target), image.width, image.height))
+    return previews
+
+
+def _process_pool(workers: int) -> ProcessPoolExecutor:
+    # Forking a process that runs an event loop, asyncpg and thread pools can leave
+    # locks held in the children; workers start from a clean forkserver instead
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+
+class ThumbnailPool:
+    """
+    Generates image previews off the request path. Blobs are queued by
+    content hash, so content that was uploaded several times is processed
+    once, and rendered in a process pool by a fixed number of worker tasks.
+    The previews are recorded in the thumbnails table; a blob is marked as
+    done even when it could not be decoded, so it is not retried forever.
+    """
+
+    def __init__(self, sizes: List[int], directory: str = THUMBNAILS_DIR, quality: int = 70, processes: int = 2,
+                 queue_size: int = 1000):
+        self.sizes = sizes
+        self.directory = directory
+        self.quality = quality
+        self.processes = processes
+        self.queue_size = queue_size
+        self.generated = 0
+        self.failed = 0
+        self.dropped = 0
+        self.skipped = 0
+        self._pending: Set[str] = set()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._executor = _process_pool(self.processes)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.processes)]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def enqueue(self, content_hash: str, path: str) -> bool:
+        if not available() or content_hash in self._pending:
+            return False
+        self.start()
+        try:
+            self._queue.put_nowait((content_hash, path))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log.warning("Thumbnail queue is full, dropping image")
+            return False
+        self._pending.add(content_hash)
+        return True
+
+    async def join(self) -> None:
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _worker(self) -> None:
+        while True:
+            content_hash, path = await self._queue.get()
+            try:
+                await self.generate(content_hash, path)
+            except Exception:
+                log.exception(f"Thumbnails of {content_hash} failed")
+            finally:
+                self._pending.discard(content_hash)
+                self._queue.task_done()
+
+    async def render(self, content_hash: str, path: str) -> Optional[List[Preview]]:
+        if self._executor is None:
+            self._executor = _process_pool(self.processes)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self._executor, render_previews, path, content_hash, self.sizes, self.directory, self.quality
+            )
+        except Exception as e:
+            self.failed += 1
+            log.info(f"Cannot make previews of {path}: {e!r}")
+            return None
+
+    async def generate(self, content_hash: str, path: str) -> bool:
+        if await thumbnails_done(content_hash):
+            self.skipped += 1
+            return False
+        previews = await self.render(content_hash, path)
+        await record_previews(content_hash, previews or [])
+        if previews:
+            self.generated += 1
+        return bool(previews)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": available(),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "generated": self.generated,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+        }
+
+
+@db_required
+async def thumbnails_done(content_hash: str) -> bool:
+    return bool(await config.db.fetchval("SELECT thumbnailed_at IS NOT NULL FROM blobs WHERE hash = $1;",
+                                         content_hash))
+
+
+@db_required
+async def record_previews(content_hash: str, previews: List[Preview]) -> None:
+    columns = [list(column) for column in zip(*previews)] or [[]] * 5
+    async with config.db.acquire() as con:
+        async with con.transaction():
+            await con.execute(
+                "INSERT INTO thumbnails (content_hash, size, path, bytes, width, height) "
+                "SELECT $1, * FROM unnest($2::int4[], $3::varchar[], $4::int8[], $5::int4[], $6::int4[]) "
+                "ON CONFLICT (content_hash, size) DO UPDATE SET path = excluded.path, bytes = excluded.bytes, "
+                "width = excluded.width, height = excluded.height;",
+                content_hash, *columns,
+            )
+            await con.execute("UPDATE blobs SET thumbnailed_at = current_timestamp WHERE hash = $1;", content_hash)
+
+
+@db_required
+async def get_thumbnail(content_hash: str, size: int) -> Optional[Dict[str, Any]]:
+    """
+    The smallest preview of a blob that is at least `size` pixels, or its
+    largest one when all are smaller. None while none was generated.
+    """
+    thumbnail = await config.db.fetchrow(
+        "SELECT size, path, bytes, width, height FROM thumbnails WHERE content_hash = $1 "
+        "ORDER BY size < $2, abs(size - $2) LIMIT 1;", content_hash, size)
+    return dict(thumbnail) if thumbnail else None
+
+
+thumbnail_pool = ThumbnailPool(config.settings.thumbnail_sizes,
+                               quality=config.settings.thumbnail_quality,
+                               processes=config.settings.thumbnail_processes,
+                               queue_size=config.settings.thumbnail_queue_size)
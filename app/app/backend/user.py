@@ -1,21 +1,34 @@
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 from asyncpg.exceptions import UniqueViolationError
-from passlib.hash import pbkdf2_sha256
 from pydantic import EmailStr
 
 from app.app.backend import config
+from app.app.backend.bus import delivery_bus, NODE
+from app.app.backend.cache import identity_cache, chat_tokens_cache
 from app.app.backend.exceptions import NickTaken, EmailTaken, AuthenticationError, ObjectNotFound
+from app.app.backend.hashing import hash_password, verify_password
 from app.app.backend.utils import db_required, insert_with_unique_id
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
 
+async def __identity_changed__(user_id: int) -> None:
+    identity_cache.invalidate(user_id)
+    await delivery_bus.publish("user", u=user_id)
+
+
+async def __on_user_event__(event: Dict[str, Any]) -> None:
+    # The account changed in another process, its cached identity is stale here too
+    if event["n"] != NODE:
+        identity_cache.invalidate(event["u"])
+
+
 @db_required
 async def register(nick: str, password: str, email: EmailStr, name: str):
-    password_hash = pbkdf2_sha256.hash(password)
+    password_hash = await hash_password(password)
     try:
         return await insert_with_unique_id(
             "users_authentication",
@@ -34,7 +47,7 @@ async def authenticate(nick: str, password: str) -> str:
     if user := await config.db.fetchrow(
             "SELECT id, passwd_hash FROM users_authentication WHERE nick = $1;", nick
     ):
-        if pbkdf2_sha256.verify(password, user["passwd_hash"]):
+        if await verify_password(password, user["passwd_hash"]):
             return user["id"]
     raise AuthenticationError()
 
@@ -60,6 +73,14 @@ async def get_user_info(current_user: Optional[int] = None, user_id: Optional[in
             raise ObjectNotFound()
 
 
+@db_required
+async def get_identity(user_id: int) -> Dict[str, Any]:
+    if (identity := identity_cache.get(user_id)) is None:
+        identity = await get_user_info(current_user=user_id, user_id=user_id)
+        identity_cache.put(user_id, identity)
+    return dict(identity)
+
+
 @db_required
 async def temporary_registration(user_id: int, verification_code: int):
     await config.db.execute(f'insert into registration_verification_codes(id, mailCode) values ($1, $2);',
@@ -89,16 +110,18 @@ async def verification_attempt(user_id: int, verification_code: int):
 @db_required
 async def delete_user_system(current_user: int):
     if result := await config.db.execute(f'DELETE FROM users_authentication WHERE id = $1;', current_user):
+        await __identity_changed__(current_user)
         return result
     raise ObjectNotFound()
 
 
 @db_required
 async def change_pass(current_user: int, password: str):
-    password_hash = pbkdf2_sha256.hash(password)
+    password_hash = await hash_password(password)
     if result := await config.db.execute(f'UPDATE users_authentication SET passwd_hash = $1 WHERE id = $2;',
                                          password_hash,
                                          current_user):
+        await __identity_changed__(current_user)
         return result
     raise ObjectNotFound()
 
@@ -107,35 +130,39 @@ async def change_pass(current_user: int, password: str):
 async def change_email(current_user: int, email: EmailStr):
     if result := await config.db.execute(f'UPDATE users_authentication SET email = $1 WHERE id = $2;', email,
                                          current_user):
+        await __identity_changed__(current_user)
         return result
     raise ObjectNotFound()
 
 
 @db_required
 async def insert_fcm_token(current_user: int, fcm_token: str):
-    await config.db.execute("UPDATE users_authentication SET devices_token_list ="
-                            " array_append(users_authentication.devices_token_list, $2::varchar) "
-                            "WHERE ID = $1 AND NOT ($2= ANY(users_authentication.devices_token_list));",
-                            current_user,
-                            fcm_token,
-                            )
+    await config.db.execute(
+        "insert into device_tokens(token, user_id) values ($2, $1) "
+        "on conflict (token) do update set user_id = excluded.user_id, registered_at = current_timestamp;",
+        current_user,
+        fcm_token,
+    )
+    chat_tokens_cache.forget_tokens([fcm_token])
+    chat_tokens_cache.forget_user(current_user)
 
 
 @db_required
 async def delete_fcm_token(current_user: int, fcm_token: str):
     if result := await config.db.execute(
-            "update users_authentication set devices_token_list = array_remove(devices_token_list, $2::varchar)"
-            " where id = $1 and $2 = any(devices_token_list);",
+            "delete from device_tokens where user_id = $1 and token = $2;",
             current_user,
             fcm_token,
     ):
+        chat_tokens_cache.forget_user(current_user)
         return result
     raise ObjectNotFound()
 
 
 @db_required
-async def check_duplicate_fcm_token(fcm_token: str):
-    await config.db.execute(
-        "update users_authentication set devices_token_list = array_remove(devices_token_list, $1::varchar);",
-        fcm_token,
-    )
+async def remove_fcm_tokens(fcm_tokens: List[str]):
+    await config.db.execute("delete from device_tokens where token = any($1::varchar[]);", fcm_tokens)
+    chat_tokens_cache.forget_tokens(fcm_tokens)
+
+
+delivery_bus.on("user", __on_user_event__)
@@ -1,9 +1,27 @@
 from app.app.backend import config
-from app.app.backend.exceptions import NotInitialised, ObjectNotFound
+from app.app.backend.exceptions import NotInitialised, ObjectNotFound, InvalidRange
+from asyncpg import Connection
 from asyncpg.exceptions import UniqueViolationError
 from functools import update_wrapper
-import random
-from typing import Tuple, Any
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Tuple, Any, Optional, List
+
+log = logging.getLogger(__name__)
+
+ID_EPOCH_MS = 1577836800000  # 2020-01-01 00:00:00 UTC
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
 
 
 def db_required(func):
@@ -16,38 +34,186 @@ def db_required(func):
     return wrapper
 
 
+def encode_cursor(*values: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def _cursor_value_is(value: Any, expected: type) -> bool:
+    # Cursors end up as query parameters, a value of the wrong type or out of int8 range would fail in the database
+    if isinstance(value, bool):
+        return False
+    if expected is int:
+        return isinstance(value, int) and -(1 << 63) <= value < (1 << 63)
+    if expected is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, expected)
+
+
+def decode_cursor(cursor: str, types: Tuple[type, ...]) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidRange()
+    if not isinstance(values, list) or len(values) != len(types) \
+            or not all(_cursor_value_is(value, expected) for value, expected in zip(values, types)):
+        raise InvalidRange()
+    return values
+
+
+class IdGenerator:
+    """
+    Snowflake-style 63-bit ids: milliseconds since ID_EPOCH_MS, then the
+    worker id, then a per-millisecond sequence. Ids from one worker are
+    strictly increasing, ids from different workers never collide.
+    """
+
+    def __init__(self, worker_id: int, epoch_ms: int = ID_EPOCH_MS):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"Worker id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.epoch_ms = epoch_ms
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _now_ms() -> int:
+        return int(time.time() * 1000)
+
+    def next_id(self) -> int:
+        with self._lock:
+            # Never step back in time: if the clock moved backwards or the sequence
+            # of the current millisecond is exhausted, keep counting from the last one
+            now = max(self._now_ms(), self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - self.epoch_ms) << (WORKER_ID_BITS + SEQUENCE_BITS)) \
+                | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+id_generator: Optional[IdGenerator] = None
+
+# Inserts that hit an id already taken are retried this many times with a fresh id
+ID_ATTEMPTS = 3
+
+LEASE_WORKER_ID = """
+with free as (
+    select slot from generate_series(0, $3::int4) slot
+    left join worker_leases l on l.worker_id = slot
+    where l.worker_id is null or l.expires_at < current_timestamp
+    order by random()
+    limit 1
+)
+insert into worker_leases (worker_id, holder, expires_at)
+select slot, $1, current_timestamp + make_interval(secs => $2) from free
+on conflict (worker_id) do update set holder = excluded.holder, expires_at = excluded.expires_at
+    where worker_leases.expires_at < current_timestamp
+returning worker_id;
+"""
+
+
+class WorkerLease:
+    """
+    Leases the worker id of this process from the worker_leases table, so
+    no two live processes share one, and renews it every third of `ttl`.
+    The lease of a process that died expires and its id is handed out again.
+    """
+
+    def __init__(self, ttl: float = 60.0, attempts: int = 5):
+        self.ttl = ttl
+        self.attempts = attempts
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.worker_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def acquire(self) -> int:
+        # Two processes may pick the same free slot, the one that loses the race picks again
+        for _ in range(self.attempts):
+            if (worker_id := await config.db.fetchval(LEASE_WORKER_ID, self.holder, self.ttl,
+                                                      MAX_WORKER_ID)) is not None:
+                self.worker_id = worker_id
+                return worker_id
+        raise RuntimeError(f"Cannot lease a worker id, all {MAX_WORKER_ID + 1} may be taken")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._renew())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if self.worker_id is not None:
+            await config.db.execute("DELETE FROM worker_leases WHERE worker_id = $1 AND holder = $2;",
+                                    self.worker_id, self.holder)
+
+    async def _renew(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                status = await config.db.execute(
+                    "UPDATE worker_leases SET expires_at = current_timestamp + make_interval(secs => $3) "
+                    "WHERE worker_id = $1 AND holder = $2;", self.worker_id, self.holder, self.ttl)
+                if status == "UPDATE 0":
+                    log.error(f"Lease of worker id {self.worker_id} was lost, leasing another one")
+                    set_worker_id(await self.acquire())
+            except Exception as e:
+                log.warning(f"Renewing the lease of worker id {self.worker_id} failed: {e!r}")
+
+
+worker_lease = WorkerLease(config.settings.worker_lease_ttl)
+
+
+def set_worker_id(worker_id: int) -> None:
+    global id_generator
+    id_generator = IdGenerator(worker_id)
+    log.info(f"Generating ids as worker {worker_id}")
+
+
 def generate_id() -> int:
-    return random.randint(1, 999999)
+    if id_generator is None:
+        # Without PP_WORKER_ID, backend.init leases a worker id from the database
+        if config.settings.worker_id is None:
+            raise NotInitialised()
+        set_worker_id(config.settings.worker_id)
+    return id_generator.next_id()
 
 
 @db_required
 async def insert_with_unique_id(
-        table: str, columns: Tuple[str, ...], values: Tuple[Any, ...]
+        table: str, columns: Tuple[str, ...], values: Tuple[Any, ...], con: Optional[Connection] = None
 ) -> int:
-    while 1:
+    query = f'INSERT INTO {table} (id, {", ".join(columns)}) ' \
+            f'VALUES ($1, {", ".join([f"${i}" for i in range(2, len(values) + 2)])});'
+    for attempt in range(1, ID_ATTEMPTS + 1):
         uid = generate_id()
         try:
-            await config.db.execute(
-                f'INSERT INTO {table} (id, {", ".join(columns)}) VALUES ($1, {", ".join([f"${i}" for i in range(2, len(values) + 2)])});',
-                uid,
-                *values,
-            )
+            if con is not None and con.is_in_transaction():
+                # Savepoint, so a collision does not abort the caller's transaction
+                async with con.transaction():
+                    await con.execute(query, uid, *values)
+            else:
+                await (con or config.db).execute(query, uid, *values)
             return uid
         except UniqueViolationError as e:
-            if e.constraint_name == f"{table}_id_pkey":
-                continue
-            else:
-                # TODO coolision id detected
-                raise e
+            if e.constraint_name != f"{table}_pkey" or attempt == ID_ATTEMPTS:
+                raise
+            log.warning(f"Id {uid} is already taken in {table}, retrying with a new one")
 
 
 @db_required
 async def insert_without_unique_id(
-        table: str, columns: Tuple[str, ...], values: Tuple[Any, ...]
+        table: str, columns: Tuple[str, ...], values: Tuple[Any, ...], con: Optional[Connection] = None
 ) -> bool:
     while 1:
         try:
-            await config.db.execute(
+            await (con or config.db).execute(
                 f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join([f"${i}" for i in range(1, len(values) + 1)])});',
                 *values,
                 )
@@ -61,9 +227,10 @@ async def insert_without_unique_id(
 
 
 @db_required
-async def get_attachment(file_uri: str):
-    if file_path := await config.db.fetchrow(
-            f'select path_original from sources where inner_uri = $1 and is_public=TRUE limit 1;',
+async def get_attachment(file_uri: str) -> dict:
+    if source := await config.db.fetchrow(
+            'select inner_uri, path_original, content_hash from sources '
+            'where inner_uri = $1 and is_public=TRUE limit 1;',
             file_uri):
-        return file_path["path_original"]
+        return dict(source)
     raise ObjectNotFound()
@@ -0,0 +1,73 @@
+"""
+Renders the previews of image attachments uploaded before the thumbnail
+pipeline existed. Safe to run again, or next to a running server: blobs
+that already went through the pipeline are skipped. Run from the
+repository root:
+
+    python -m app.app.backfill_thumbnails [--batch-size 200]
+"""
+import argparse
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from app.app.backend import config
+from app.app.backend import init as init_db
+from app.app.backend.storage import content_hash_of
+from app.app.backend.thumbnails import thumbnail_pool, is_image, available
+from app.app.settings import Settings
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+PENDING_SOURCES = """
+select s.inner_uri, s.path_original, s.content_hash
+from sources s
+left join blobs b on b.hash = s.content_hash
+where s.inner_uri > $1 and b.thumbnailed_at is null
+order by s.inner_uri
+limit $2;
+"""
+
+
+async def backfill(batch_size: int) -> None:
+    last_uri, seen, missing = "", 0, 0
+    while sources := await config.db.fetch(PENDING_SOURCES, last_uri, batch_size):
+        last_uri = sources[-1]["inner_uri"]
+        blobs = {}
+        for source in sources:
+            if not is_image(source["inner_uri"]):
+                continue
+            try:
+                # Sources from before content addressing are hashed and get their blob here
+                blobs.setdefault(await content_hash_of(dict(source)), source["path_original"])
+            except OSError as e:
+                missing += 1
+                log.warning(f"Skipping {source['inner_uri']}: {e!r}")
+        seen += len(sources)
+        await asyncio.gather(*(thumbnail_pool.generate(content_hash, path) for content_hash, path in blobs.items()))
+        log.info(f"{seen} sources checked, {thumbnail_pool.stats()}")
+    log.info(f"Done: {seen} sources checked, {missing} files missing, {thumbnail_pool.stats()}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Render previews of existing image attachments")
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+    if not available():
+        raise SystemExit("Pillow is not installed, previews cannot be rendered")
+    dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+    if os.path.exists(dotenv_path):
+        load_dotenv(dotenv_path)
+    await init_db(settings=Settings())
+    try:
+        await backfill(args.batch_size)
+    finally:
+        await thumbnail_pool.close()
+        await config.db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,22 @@
+-- Move push tokens from users_authentication.devices_token_list into their own table
+begin;
+
+create table if not exists device_tokens(
+    token varchar,
+    user_id int8 references users_authentication on delete cascade not null,
+    registered_at timestamptz default current_timestamp not null,
+
+    primary key (token)
+);
+create index if not exists device_tokens_user_ind
+    on device_tokens(user_id);
+
+insert into device_tokens(token, user_id)
+select distinct on (token) token, id
+from users_authentication, unnest(devices_token_list) as token
+where token is not null and token <> ''
+on conflict (token) do nothing;
+
+alter table users_authentication drop column if exists devices_token_list;
+
+commit;
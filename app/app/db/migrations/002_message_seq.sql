@@ -0,0 +1,22 @@
+-- Per-chat message sequence numbers replace the global unique sent_time
+begin;
+
+alter table chats add column if not exists last_seq int8 default 0 not null;
+alter table messages add column if not exists seq int8;
+
+update messages m
+set seq = numbered.seq
+from (
+    select id, row_number() over (partition by chat_attached_id order by sent_time, id) as seq
+    from messages
+) numbered
+where m.id = numbered.id;
+
+update chats c
+set last_seq = coalesce((select max(seq) from messages where chat_attached_id = c.id), 0);
+
+alter table messages alter column seq set not null;
+alter table messages drop constraint if exists time_unique;
+alter table messages add constraint chat_seq_unique unique (chat_attached_id, seq);
+
+commit;
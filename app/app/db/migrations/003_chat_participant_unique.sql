@@ -0,0 +1,12 @@
+-- Forbid duplicate memberships so the in-process membership index cannot drift from the table
+begin;
+
+delete from chat_participants a
+using chat_participants b
+where a.chat_id = b.chat_id
+  and a.participant_id = b.participant_id
+  and (a.is_admin, a.ctid) < (b.is_admin, b.ctid);
+
+alter table chat_participants add constraint chat_participant_unique unique (chat_id, participant_id);
+
+commit;
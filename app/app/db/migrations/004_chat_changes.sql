@@ -0,0 +1,87 @@
+-- Append-only log of the changes in every chat, read by /chats/sync.
+-- Entries carry the id of the writing transaction so readers can stop at the oldest one still running
+-- and never skip an entry that commits out of order.
+begin;
+
+create table if not exists chat_changes(
+    id bigserial,
+    txid int8 default txid_current() not null,
+    chat_id int8 not null,
+    kind varchar not null,
+    object_id int8,
+    target_user int8,
+    data jsonb,
+    created_at timestamptz default current_timestamp not null,
+
+    primary key (id)
+);
+create index if not exists chat_changes_chat_ind
+    on chat_changes(chat_id, txid, id);
+create index if not exists chat_changes_target_ind
+    on chat_changes(target_user, txid, id)
+    where target_user is not null;
+
+create or replace function log_message_change()
+returns trigger as $$
+begin
+    if tg_op = 'INSERT' then
+        insert into chat_changes(chat_id, kind, object_id) values (new.chat_attached_id, 'message_created', new.id);
+    elsif tg_op = 'UPDATE' then
+        insert into chat_changes(chat_id, kind, object_id) values (new.chat_attached_id, 'message_edited', new.id);
+    elsif exists(select from chats where id = old.chat_attached_id) then
+        -- Messages of a deleted chat go with it, the member_removed entries already tell the clients
+        insert into chat_changes(chat_id, kind, object_id) values (old.chat_attached_id, 'message_deleted', old.id);
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+create or replace function log_participant_change()
+returns trigger as $$
+begin
+    if tg_op = 'INSERT' then
+        insert into chat_changes(chat_id, kind, object_id, data)
+        values (new.chat_id, 'member_added', new.participant_id, jsonb_build_object('is_admin', new.is_admin));
+    elsif tg_op = 'UPDATE' then
+        insert into chat_changes(chat_id, kind, object_id, data)
+        values (new.chat_id, 'member_updated', new.participant_id, jsonb_build_object('is_admin', new.is_admin));
+    else
+        -- Addressed to the removed user too, who no longer sees the changes of the chat
+        insert into chat_changes(chat_id, kind, object_id, target_user)
+        values (old.chat_id, 'member_removed', old.participant_id, old.participant_id);
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+create or replace function log_chat_change()
+returns trigger as $$
+declare changed jsonb;
+begin
+    -- Only the properties that changed; counters maintained by every message are not changes of the chat
+    select jsonb_object_agg(n.key, n.value) into changed
+    from jsonb_each(to_jsonb(new)) n join jsonb_each(to_jsonb(old)) o using (key)
+    where n.value is distinct from o.value and n.key not in ('last_seq');
+    if changed is not null then
+        insert into chat_changes(chat_id, kind, data) values (new.id, 'chat_updated', changed);
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+drop trigger if exists messages_log_change on messages;
+create trigger messages_log_change
+    after insert or delete or update of body, tag_list, has_attached_file on messages
+    for each row execute procedure log_message_change();
+
+drop trigger if exists chat_participants_log_change on chat_participants;
+create trigger chat_participants_log_change
+    after insert or delete or update of is_admin on chat_participants
+    for each row execute procedure log_participant_change();
+
+drop trigger if exists chats_log_change on chats;
+create trigger chats_log_change
+    after update on chats
+    for each row execute procedure log_chat_change();
+
+commit;
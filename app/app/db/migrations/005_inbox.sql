@@ -0,0 +1,33 @@
+-- Inbox: chats ordered by their last activity, unread counts from a read cursor per participant.
+-- The last message of a chat is found through last_seq and the chat_seq_unique index.
+-- last_activity is deliberately not indexed: it changes with every message and must stay a HOT update.
+begin;
+
+alter table chats add column if not exists last_activity timestamptz default current_timestamp not null;
+alter table chat_participants add column if not exists last_read_seq int8 default 0 not null;
+
+update chats c
+set last_activity = coalesce((select max(sent_time) from messages where chat_attached_id = c.id), c.last_activity);
+
+-- Existing members start with everything read rather than with the whole history unread
+update chat_participants p
+set last_read_seq = c.last_seq
+from chats c
+where c.id = p.chat_id;
+
+create or replace function log_chat_change()
+returns trigger as $$
+declare changed jsonb;
+begin
+    -- Only the properties that changed; counters maintained by every message are not changes of the chat
+    select jsonb_object_agg(n.key, n.value) into changed
+    from jsonb_each(to_jsonb(new)) n join jsonb_each(to_jsonb(old)) o using (key)
+    where n.value is distinct from o.value and n.key not in ('last_seq', 'last_activity');
+    if changed is not null then
+        insert into chat_changes(chat_id, kind, data) values (new.id, 'chat_updated', changed);
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+commit;
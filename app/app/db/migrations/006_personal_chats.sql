@@ -0,0 +1,16 @@
+-- One row per unordered pair of users with a personal chat, the smaller id first.
+-- The chat is created after the pair is claimed, so the foreign key is only checked at commit.
+begin;
+
+create table if not exists personal_chats(
+    user_low int8 references users_authentication on delete cascade not null,
+    user_high int8 references users_authentication on delete cascade not null,
+    chat_id int8 references chats on delete cascade deferrable initially deferred not null,
+
+    primary key (user_low, user_high),
+    constraint personal_pair_ordered check (user_low < user_high)
+);
+create unique index if not exists personal_chats_chat_ind
+    on personal_chats(chat_id);
+
+commit;
@@ -0,0 +1,61 @@
+-- Tag search through a GIN index on (chat, tags) and per-chat tag counters kept by a trigger
+begin;
+
+create extension if not exists btree_gin;
+
+create index if not exists messages_chat_tags_ind
+    on messages using gin (chat_attached_id, tag_list);
+
+create table if not exists chat_tag_counts(
+    chat_id int8 references chats on delete cascade not null,
+    tag varchar not null,
+    count int8 not null,
+
+    primary key (chat_id, tag)
+);
+
+create or replace function count_message_tags()
+returns trigger as $$
+declare
+    chat int8;
+    old_tags varchar[] := '{}';
+    new_tags varchar[] := '{}';
+begin
+    if tg_op <> 'INSERT' then
+        chat := old.chat_attached_id;
+        old_tags := old.tag_list;
+    end if;
+    if tg_op <> 'DELETE' then
+        chat := new.chat_attached_id;
+        new_tags := new.tag_list;
+    end if;
+    if old_tags is not distinct from new_tags then
+        return null;
+    end if;
+    -- Every distinct tag of a message counts once
+    update chat_tag_counts
+    set count = count - 1
+    where chat_id = chat and tag in (select unnest(old_tags) except select unnest(new_tags));
+    delete from chat_tag_counts where chat_id = chat and tag = any(old_tags) and count <= 0;
+    if tg_op <> 'DELETE' then
+        insert into chat_tag_counts(chat_id, tag, count)
+        select chat, tag, 1
+        from (select unnest(new_tags) except select unnest(old_tags)) added(tag)
+        on conflict (chat_id, tag) do update set count = chat_tag_counts.count + 1;
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+drop trigger if exists messages_count_tags on messages;
+create trigger messages_count_tags
+    after insert or delete or update of tag_list on messages
+    for each row execute procedure count_message_tags();
+
+insert into chat_tag_counts(chat_id, tag, count)
+select chat_attached_id, tag, count(*)
+from (select distinct id, chat_attached_id, unnest(tag_list) as tag from messages) tags
+group by chat_attached_id, tag
+on conflict (chat_id, tag) do update set count = excluded.count;
+
+commit;
@@ -0,0 +1,11 @@
+-- Full-text search over message bodies. The 'simple' configuration does no stemming, which suits chats mixing
+-- languages; the vector is computed by Postgres on every write of the body.
+begin;
+
+alter table messages add column if not exists body_search tsvector
+    generated always as (to_tsvector('simple', coalesce(body, ''))) stored;
+
+create index if not exists messages_body_search_ind
+    on messages using gin (body_search);
+
+commit;
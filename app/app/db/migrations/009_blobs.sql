@@ -0,0 +1,38 @@
+-- Attachments are stored once per content under their SHA-256 hash; sources point at the blob they use.
+-- Several sources may now share a file, so their paths are no longer unique.
+begin;
+
+create table if not exists blobs(
+    hash varchar,
+    size int8 not null,
+    path varchar not null,
+    ref_count int8 default 0 not null,
+    created_at timestamptz default current_timestamp not null,
+
+    primary key (hash)
+);
+
+alter table sources add column if not exists content_hash varchar references blobs on delete restrict;
+alter table sources drop constraint if exists _unique_originalpath;
+drop index if exists source_thumbnail;
+create index if not exists sources_content_hash_ind
+    on sources(content_hash);
+
+create or replace function count_blob_refs()
+returns trigger as $$
+begin
+    if tg_op = 'INSERT' then
+        update blobs set ref_count = ref_count + 1 where hash = new.content_hash;
+    else
+        update blobs set ref_count = ref_count - 1 where hash = old.content_hash;
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+drop trigger if exists sources_count_blob_refs on sources;
+create trigger sources_count_blob_refs
+    after insert or delete on sources
+    for each row execute procedure count_blob_refs();
+
+commit;
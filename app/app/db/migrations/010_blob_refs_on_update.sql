@@ -0,0 +1,22 @@
+-- Sources uploaded before content addressing get their hash lazily, count those references too
+begin;
+
+create or replace function count_blob_refs()
+returns trigger as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') and old.content_hash is not null then
+        update blobs set ref_count = ref_count - 1 where hash = old.content_hash;
+    end if;
+    if tg_op in ('UPDATE', 'INSERT') and new.content_hash is not null then
+        update blobs set ref_count = ref_count + 1 where hash = new.content_hash;
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+drop trigger if exists sources_count_blob_refs on sources;
+create trigger sources_count_blob_refs
+    after insert or delete or update of content_hash on sources
+    for each row execute procedure count_blob_refs();
+
+commit;
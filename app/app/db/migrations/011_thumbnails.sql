@@ -0,0 +1,18 @@
+-- Image previews are made per blob, so content uploaded several times is processed once.
+-- blobs.thumbnailed_at is set once a blob went through the pipeline, also when it could not be decoded.
+begin;
+
+alter table blobs add column if not exists thumbnailed_at timestamptz default null;
+
+create table if not exists thumbnails(
+    content_hash varchar references blobs on delete cascade,
+    size int4,
+    path varchar not null,
+    bytes int8 not null,
+    width int4 not null,
+    height int4 not null,
+
+    primary key (content_hash, size)
+);
+
+commit;
@@ -0,0 +1,13 @@
+-- Every server process leases the worker id of its id generator, so no two live processes share one.
+-- A lease that is not renewed before expires_at can be taken by another process.
+begin;
+
+create table if not exists worker_leases(
+    worker_id int4,
+    holder varchar not null,
+    expires_at timestamptz not null,
+
+    primary key (worker_id)
+);
+
+commit;
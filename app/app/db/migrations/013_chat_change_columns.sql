@@ -0,0 +1,10 @@
+-- chats_log_change fired for every message because of the last_seq / last_activity update.
+-- It now only fires for updates of the chat properties; new audited columns have to be added to the list.
+begin;
+
+drop trigger if exists chats_log_change on chats;
+create trigger chats_log_change
+    after update of name, creator, avatar, color_rgba, encoded on chats
+    for each row execute procedure log_chat_change();
+
+commit;
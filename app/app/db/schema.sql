@@ -1,14 +1,27 @@
 ------------------------------------------------------------------------------------------------------------------------------------------------
+drop table if exists worker_leases;
+drop table if exists chat_changes;
+drop table if exists chat_tag_counts;
+drop table if exists personal_chats;
 drop table if exists message_attachments;
+drop table if exists device_tokens;
 drop table if exists messages;
 drop table if exists chat_properties;
 drop table if exists chat_participants;
 drop table if exists chats;
 drop table if exists sources;
+drop table if exists thumbnails;
+drop table if exists blobs;
 drop table if exists registration_verification_codes;
 drop table if exists users_authentication;
 drop function if exists is_user_chat_participant;
 drop function if exists is_user_admin;
+drop function if exists log_message_change;
+drop function if exists log_participant_change;
+drop function if exists log_chat_change;
+drop function if exists count_message_tags;
+drop function if exists count_blob_refs;
+create extension if not exists btree_gin;
 ------------------------------------------------------------------------------------------------------------------------------------------------
 create table users_authentication(
 	id int8 default ('x' || right(md5(to_char(current_timestamp, 'dd-mm-yyyy hh:mi:ss:us')), 8))::bit(63)::int8,
@@ -16,7 +29,6 @@ create table users_authentication(
 	name varchar,
 	email varchar,
 	passwd_hash varchar,
-	devices_token_list varchar[] default '{}'::varchar[],
     was_confirmed bool default false,
 
 	primary key(id),
@@ -30,6 +42,24 @@ create table users_authentication(
 create index user_id
     on users_authentication (id);
 ------------------------------------------------------------------------------------------------------------------------------------------------
+create table worker_leases(
+    worker_id int4,
+    holder varchar not null,
+    expires_at timestamptz not null,
+
+    primary key (worker_id)
+);
+------------------------------------------------------------------------------------------------------------------------------------------------
+create table device_tokens(
+    token varchar,
+    user_id int8 references users_authentication on delete cascade not null,
+    registered_at timestamptz default current_timestamp not null,
+
+    primary key (token)
+);
+create index device_tokens_user_ind
+    on device_tokens(user_id);
+------------------------------------------------------------------------------------------------------------------------------------------------
 create table registration_verification_codes(
   id int8 references users_authentication(id),
   mailcode int4 not null,
@@ -37,6 +67,28 @@ create table registration_verification_codes(
   attemptsmade int2 default 0
 );
 ------------------------------------------------------------------------------------------------------------------------------------------------
+create table blobs(
+    hash varchar,
+    size int8 not null,
+    path varchar not null,
+    ref_count int8 default 0 not null,
+    created_at timestamptz default current_timestamp not null,
+    thumbnailed_at timestamptz default null,
+
+    primary key (hash)
+);
+------------------------------------------------------------------------------------------------------------------------------------------------
+create table thumbnails(
+    content_hash varchar references blobs on delete cascade,
+    size int4,
+    path varchar not null,
+    bytes int8 not null,
+    width int4 not null,
+    height int4 not null,
+
+    primary key (content_hash, size)
+);
+------------------------------------------------------------------------------------------------------------------------------------------------
 create table sources(
 	inner_uri varchar,
     is_public boolean default false,
@@ -46,16 +98,32 @@ create table sources(
 	owner int8 default 404 references users_authentication on delete set default ,
 	description varchar default null,
 	meta varchar default null,
+	content_hash varchar references blobs on delete restrict,
 
 	primary key (inner_uri),
 	constraint uri_not_null check(inner_uri is not null),
-	constraint _unique_originalpath unique(path_original),
 	constraint owner_exist check(owner is not null),
 	constraint path_existence check(path_original is not null)
 );
-create unique index source_thumbnail
-	on sources (path_thumbnail)
-	where path_thumbnail is not null;
+create index sources_content_hash_ind
+	on sources(content_hash);
+
+create function count_blob_refs()
+returns trigger as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') and old.content_hash is not null then
+        update blobs set ref_count = ref_count - 1 where hash = old.content_hash;
+    end if;
+    if tg_op in ('UPDATE', 'INSERT') and new.content_hash is not null then
+        update blobs set ref_count = ref_count + 1 where hash = new.content_hash;
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+create trigger sources_count_blob_refs
+    after insert or delete or update of content_hash on sources
+    for each row execute procedure count_blob_refs();
 ------------------------------------------------------------------------------------------------------------------------------------------------
 create table chats(
 	id int8,
@@ -64,6 +132,8 @@ create table chats(
 	avatar varchar default null references sources on delete restrict,
 	color_rgba int4 default 0,
 	encoded boolean default false,
+	last_seq int8 default 0 not null,
+	last_activity timestamptz default current_timestamp not null,
 
 	primary key (id),
 	constraint name_is_not_null check(name is not null),
@@ -86,7 +156,9 @@ create table chat_participants(
     participant_id int8 references users_authentication on delete cascade,
     chat_id int8 references chats on delete cascade,
 	is_admin boolean default false,
+	last_read_seq int8 default 0 not null,
 
+	constraint chat_participant_unique unique (chat_id, participant_id),
 	constraint participant_id_is_not_null check (participant_id is not null),
 	constraint chat_id_is_not_null check(chat_id is not null),
 	constraint is_admin_is_not_null check(is_admin is not null)
@@ -96,6 +168,17 @@ create index chat_participants_chat_ind
 create index chat_participants_user_ind
 	on chat_participants(participant_id);
 
+create table personal_chats(
+    user_low int8 references users_authentication on delete cascade not null,
+    user_high int8 references users_authentication on delete cascade not null,
+    chat_id int8 references chats on delete cascade deferrable initially deferred not null,
+
+    primary key (user_low, user_high),
+    constraint personal_pair_ordered check (user_low < user_high)
+);
+create unique index personal_chats_chat_ind
+    on personal_chats(chat_id);
+
 create function is_user_chat_participant(_user_id int8, _chat_id int8)
 returns boolean as $$
 declare passed boolean;
@@ -115,15 +198,17 @@ $$  language plpgsql;
 create table messages(
     id int8,
 	chat_attached_id int8 references chats(id) on delete cascade,
+	seq int8 not null,
 	author_id int8 references users_authentication(id) on delete cascade,
 	sent_time timestamptz default current_timestamp::timestamptz,
 	tag_list varchar[] default array[]::varchar[],
 	body text default '',
 	has_attached_file boolean default false not null,
 	was_modified boolean default false,
+	body_search tsvector generated always as (to_tsvector('simple', coalesce(body, ''))) stored,
 
 	primary key (id),
-	constraint time_unique unique (sent_time),
+	constraint chat_seq_unique unique (chat_attached_id, seq),
 	constraint not_empty_message check (id is not null and chat_attached_id is not null and tag_list is not null
 									   and (body is not null and body <> '' or has_attached_file)),
     constraint author_is_participant check(is_user_chat_participant(author_id, chat_attached_id) or author_id = 1)
@@ -132,9 +217,137 @@ create index chat_ind
     on messages(chat_attached_id);
 create unique index message_ind
 	on messages(id);
+create index messages_chat_tags_ind
+    on messages using gin (chat_attached_id, tag_list);
+create index messages_body_search_ind
+    on messages using gin (body_search);
 ------------------------------------------------------------------------------------------------------------------------------------------------
 create table message_attachments(
     chat_attached_id int8,
     message_attached_id int8,
 	uri varchar references sources(inner_uri) on delete restrict
-);
\ No newline at end of file
+);
+------------------------------------------------------------------------------------------------------------------------------------------------
+create table chat_changes(
+    id bigserial,
+    txid int8 default txid_current() not null,
+    chat_id int8 not null,
+    kind varchar not null,
+    object_id int8,
+    target_user int8,
+    data jsonb,
+    created_at timestamptz default current_timestamp not null,
+
+    primary key (id)
+);
+create index chat_changes_chat_ind
+    on chat_changes(chat_id, txid, id);
+create index chat_changes_target_ind
+    on chat_changes(target_user, txid, id)
+    where target_user is not null;
+
+create function log_message_change()
+returns trigger as $$
+begin
+    if tg_op = 'INSERT' then
+        insert into chat_changes(chat_id, kind, object_id) values (new.chat_attached_id, 'message_created', new.id);
+    elsif tg_op = 'UPDATE' then
+        insert into chat_changes(chat_id, kind, object_id) values (new.chat_attached_id, 'message_edited', new.id);
+    elsif exists(select from chats where id = old.chat_attached_id) then
+        -- Messages of a deleted chat go with it, the member_removed entries already tell the clients
+        insert into chat_changes(chat_id, kind, object_id) values (old.chat_attached_id, 'message_deleted', old.id);
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+create function log_participant_change()
+returns trigger as $$
+begin
+    if tg_op = 'INSERT' then
+        insert into chat_changes(chat_id, kind, object_id, data)
+        values (new.chat_id, 'member_added', new.participant_id, jsonb_build_object('is_admin', new.is_admin));
+    elsif tg_op = 'UPDATE' then
+        insert into chat_changes(chat_id, kind, object_id, data)
+        values (new.chat_id, 'member_updated', new.participant_id, jsonb_build_object('is_admin', new.is_admin));
+    else
+        -- Addressed to the removed user too, who no longer sees the changes of the chat
+        insert into chat_changes(chat_id, kind, object_id, target_user)
+        values (old.chat_id, 'member_removed', old.participant_id, old.participant_id);
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+create function log_chat_change()
+returns trigger as $$
+declare changed jsonb;
+begin
+    -- Only the properties that changed; counters maintained by every message are not changes of the chat
+    select jsonb_object_agg(n.key, n.value) into changed
+    from jsonb_each(to_jsonb(new)) n join jsonb_each(to_jsonb(old)) o using (key)
+    where n.value is distinct from o.value and n.key not in ('last_seq', 'last_activity');
+    if changed is not null then
+        insert into chat_changes(chat_id, kind, data) values (new.id, 'chat_updated', changed);
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+create trigger messages_log_change
+    after insert or delete or update of body, tag_list, has_attached_file on messages
+    for each row execute procedure log_message_change();
+
+create trigger chat_participants_log_change
+    after insert or delete or update of is_admin on chat_participants
+    for each row execute procedure log_participant_change();
+
+-- Not fired by the last_seq / last_activity update of every message
+create trigger chats_log_change
+    after update of name, creator, avatar, color_rgba, encoded on chats
+    for each row execute procedure log_chat_change();
+------------------------------------------------------------------------------------------------------------------------------------------------
+create table chat_tag_counts(
+    chat_id int8 references chats on delete cascade not null,
+    tag varchar not null,
+    count int8 not null,
+
+    primary key (chat_id, tag)
+);
+
+create function count_message_tags()
+returns trigger as $$
+declare
+    chat int8;
+    old_tags varchar[] := '{}';
+    new_tags varchar[] := '{}';
+begin
+    if tg_op <> 'INSERT' then
+        chat := old.chat_attached_id;
+        old_tags := old.tag_list;
+    end if;
+    if tg_op <> 'DELETE' then
+        chat := new.chat_attached_id;
+        new_tags := new.tag_list;
+    end if;
+    if old_tags is not distinct from new_tags then
+        return null;
+    end if;
+    -- Every distinct tag of a message counts once
+    update chat_tag_counts
+    set count = count - 1
+    where chat_id = chat and tag in (select unnest(old_tags) except select unnest(new_tags));
+    delete from chat_tag_counts where chat_id = chat and tag = any(old_tags) and count <= 0;
+    if tg_op <> 'DELETE' then
+        insert into chat_tag_counts(chat_id, tag, count)
+        select chat, tag, 1
+        from (select unnest(new_tags) except select unnest(old_tags)) added(tag)
+        on conflict (chat_id, tag) do update set count = chat_tag_counts.count + 1;
+    end if;
+    return null;
+end;
+$$  language plpgsql;
+
+create trigger messages_count_tags
+    after insert or delete or update of tag_list on messages
+    for each row execute procedure count_message_tags();
@@ -7,6 +7,7 @@ from firebase_admin import credentials
 
 from app.app.settings import Settings
 from app.app.backend import init as init_db
+from app.app.backend.bus import delivery_bus
 from configparser import ConfigParser
 from dotenv import load_dotenv
 
@@ -25,6 +26,7 @@ async def init() -> None:
                         db_pass=os.environ.get("PP_DB_PASS"))
     log.info("init db")
     await init_db(settings=settings)
+    await delivery_bus.start()
 
 
 async def main() -> None:
@@ -1,4 +1,6 @@
 import os
+from typing import List, Optional
+
 from pydantic import BaseSettings
 
 
@@ -9,10 +11,67 @@ class Settings(BaseSettings):
     db_user: str = os.environ.get('DB_USER')
     db_pass: str = os.environ.get('DB_HOST')
 
+    worker_id: Optional[int] = None
+    worker_lease_ttl: float = 60.0
+
+    identity_cache_size: int = 10000
+    identity_cache_ttl: float = 60.0
+
+    chat_info_cache_size: int = 10000
+    chat_info_cache_ttl: float = 300.0
+    membership_index_size: int = 50000
+    membership_index_ttl: float = 300.0
+
+    hash_executor: str = "thread"
+    hash_workers: int = 2
+    hash_queue_size: int = 32
+
+    fanout_queue_size: int = 10000
+    fanout_workers: int = 8
+    fanout_overflow: str = "block"
+    fanout_submit_timeout: float = 1.0
+
+    delivery_bus: str = "postgres"
+    delivery_bus_queue_size: int = 10000
+    delivery_bus_workers: int = 8
+
+    ws_queue_size: int = 256
+    ws_slow_consumer_policy: str = "drop_oldest"
+    ws_send_timeout: float = 10.0
+    ws_max_inflight: int = 16
+    ws_heartbeat_interval: float = 30.0
+    ws_idle_timeout: float = 75.0
+    ws_wheel_tick: float = 1.0
+
+    replay_chats: int = 10000
+    replay_ring_size: int = 128
+    replay_db_limit: int = 100
+
+    attachments_dir: Optional[str] = None
+    upload_chunk_size: int = 1024 * 1024
+    upload_threads: int = 4
+    download_zerocopy_min_size: int = 256 * 1024
+
+    thumbnails_dir: Optional[str] = None
+    thumbnail_sizes: List[int] = [64, 256, 640]
+    thumbnail_quality: int = 70
+    thumbnail_processes: int = 2
+    thumbnail_queue_size: int = 1000
+
+    push_queue_size: int = 10000
+    push_workers: int = 4
+    push_threads: int = 8
+    push_max_retries: int = 3
+    push_retry_backoff: float = 0.5
+    push_tokens_cache_size: int = 10000
+    push_tokens_cache_ttl: float = 30.0
+
     class Config:
         env_prefix = "PP_"
 
 
 class TestSettings(Settings):
+    worker_id: Optional[int] = 0
+
     class Config:
         env_prefix = "PP_TEST_"
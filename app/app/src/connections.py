@@ -0,0 +1,272 @@
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Set, Union
+import logging
+import math
+import time
+
+import asyncio
+from fastapi import WebSocket
+
+from app.app.backend import config
+from app.app.src.wire import Frame, JSON
+
+log = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+COALESCE = "coalesce"
+
+# Sent instead of a backlog that was coalesced: the client has to catch up over HTTP
+RESYNC_FRAME = Frame({"message_type": "resync"})
+# Sent to heartbeat connections that were quiet for a heartbeat interval; clients answer with {"op": "pong"}
+PING_FRAME = Frame({"message_type": "ping"})
+
+Outgoing = Union[Frame, str, bytes]
+
+
+class Connection:
+    """
+    One websocket of a user. Frames are put on a bounded outbound queue and
+    written by a dedicated task, so a slow client only delays itself. When the
+    queue is full the slow-consumer policy decides what happens: drop the
+    oldest frame, disconnect the client or coalesce the backlog into a single
+    resync frame.
+    """
+
+    def __init__(self, user_id: int, websocket: WebSocket, queue_size: int = 256, policy: str = DROP_OLDEST,
+                 send_timeout: float = 10.0, encoding: str = JSON, heartbeat: bool = False):
+        if policy not in (DROP_OLDEST, DISCONNECT, COALESCE):
+            raise ValueError(f"Unknown slow consumer policy '{policy}'")
+        self.user_id = user_id
+        self.websocket = websocket
+        self.queue_size = queue_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.encoding = encoding
+        # Only clients that speak the heartbeat protocol are pinged and reaped when silent
+        self.heartbeat = heartbeat
+        self.dropped = 0
+        self.closed = False
+        self.last_seen = time.monotonic()
+        # Highest seq the client acknowledged, per chat
+        self.acked: Dict[int, int] = {}
+        self._queue: Deque[Union[str, bytes]] = deque()
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def start(self) -> None:
+        self._writer = asyncio.ensure_future(self._write_loop())
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+    def idle_for(self, now: Optional[float] = None) -> float:
+        return (now or time.monotonic()) - self.last_seen
+
+    def send(self, frame: Outgoing) -> bool:
+        if self.closed:
+            return False
+        if isinstance(frame, Frame):
+            frame = frame.encode(self.encoding)
+        if len(self._queue) >= self.queue_size:
+            if self.policy == DISCONNECT:
+                self.dropped += len(self._queue) + 1
+                self._queue.clear()
+                log.info(f"Disconnecting slow websocket of user {self.user_id}")
+                asyncio.ensure_future(self.close(code=1008))
+                return False
+            if self.policy == COALESCE:
+                self.dropped += len(self._queue) + 1
+                self._queue.clear()
+                self._queue.append(RESYNC_FRAME.encode(self.encoding))
+                self._ready.set()
+                return False
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append(frame)
+        self._ready.set()
+        return True
+
+    async def close(self, code: int = 1000) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _write_loop(self) -> None:
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                frame = self._queue.popleft()
+                if isinstance(frame, bytes):
+                    await asyncio.wait_for(self.websocket.send_bytes(frame), self.send_timeout)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(frame), self.send_timeout)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.info(f"Websocket of user {self.user_id} failed: {e!r}")
+            await self.close(code=1011)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel. A single task advances one slot every `tick` seconds
+    and hands the items of that slot to `on_expire`, which returns the delay
+    until the item is due again or None to drop it. Scheduling and removing
+    are set operations, so many items cost one timer between them.
+    """
+
+    def __init__(self, on_expire: Callable[[Hashable], Optional[float]], tick: float = 1.0, slots: int = 64):
+        self.on_expire = on_expire
+        self.tick = tick
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._where: Dict[Hashable, int] = {}
+        self._cursor = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def schedule(self, item: Hashable, delay: float) -> None:
+        self.discard(item)
+        # Delays longer than one turn of the wheel are clamped to it
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self._slots) - 1)
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot].add(item)
+        self._where[item] = slot
+
+    def discard(self, item: Hashable) -> None:
+        if (slot := self._where.pop(item, None)) is not None:
+            self._slots[slot].discard(item)
+
+    def advance(self) -> None:
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        due, self._slots[self._cursor] = self._slots[self._cursor], set()
+        for item in due:
+            del self._where[item]
+            try:
+                delay = self.on_expire(item)
+            except Exception:
+                log.exception("Timer wheel callback failed")
+                continue
+            if delay is not None:
+                self.schedule(item, delay)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+
+class Connections:
+    """
+    Websockets of every user on this worker. Connections that opted into the
+    heartbeat and stay silent for `heartbeat_interval` are pinged, and the
+    ones silent for `idle_timeout` are closed and forgotten, so half-open
+    sockets stop receiving frames. Listen-only clients never send anything,
+    they are left to the websocket ping control frames of the server
+    (uvicorn's `--ws-ping-interval`), which the client library answers on
+    its own. All of them are checked from one timer wheel.
+    """
+
+    def __init__(self, heartbeat_interval: float = 30.0, idle_timeout: float = 75.0, tick: float = 1.0):
+        self.active_connections: Dict[int, Set[Connection]] = {}
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.dropped_frames = 0
+        self.reaped = 0
+        self.wheel = TimerWheel(self._check, tick=tick, slots=math.ceil(heartbeat_interval / tick) + 1)
+
+    def add_user(self, user_id: int, websocket: WebSocket, encoding: str = JSON,
+                 heartbeat: bool = False) -> Connection:
+        connection = Connection(user_id, websocket,
+                                queue_size=config.settings.ws_queue_size,
+                                policy=config.settings.ws_slow_consumer_policy,
+                                send_timeout=config.settings.ws_send_timeout,
+                                encoding=encoding,
+                                heartbeat=heartbeat)
+        connection.start()
+        self.active_connections.setdefault(user_id, set()).add(connection)
+        self.wheel.schedule(connection, self.heartbeat_interval)
+        self.wheel.start()
+        return connection
+
+    def remove(self, connection: Connection) -> None:
+        user_connections = self.active_connections.get(connection.user_id, set())
+        if connection in user_connections:
+            user_connections.discard(connection)
+            self.dropped_frames += connection.dropped
+        if not user_connections:
+            self.active_connections.pop(connection.user_id, None)
+        self.wheel.discard(connection)
+        asyncio.ensure_future(connection.close())
+
+    def remove_user(self, user_id: int, websocket: WebSocket):
+        for connection in [c for c in self.active_connections.get(user_id, ()) if c.websocket is websocket]:
+            self.remove(connection)
+
+    def send_to_user(self, user_id: int, frame: Outgoing) -> int:
+        return sum(connection.send(frame) for connection in self.active_connections.get(user_id, ()))
+
+    async def close(self) -> None:
+        await self.wheel.close()
+
+    def _check(self, connection: Connection) -> Optional[float]:
+        if connection.closed:
+            return None
+        if not connection.heartbeat:
+            # Checked again later, the client may still opt in with a pong
+            return self.heartbeat_interval
+        idle = connection.idle_for()
+        if idle >= self.idle_timeout:
+            self.reaped += 1
+            log.info(f"Reaping websocket of user {connection.user_id}, idle for {idle:.0f}s")
+            self.remove(connection)
+            return None
+        if idle >= self.heartbeat_interval:
+            connection.send(PING_FRAME)
+        return self.heartbeat_interval
+
+    def stats(self):
+        all_connections = [c for user_connections in self.active_connections.values() for c in user_connections]
+        now = time.monotonic()
+        idle = sum(c.heartbeat and c.idle_for(now) >= self.heartbeat_interval for c in all_connections)
+        return {
+            "users": len(self.active_connections),
+            "connections": len(all_connections),
+            "live": len(all_connections) - idle,
+            "idle": idle,
+            "reaped": self.reaped,
+            "queued_frames": sum(c.depth for c in all_connections),
+            "max_queue_depth": max((c.depth for c in all_connections), default=0),
+            "dropped_frames": self.dropped_frames + sum(c.dropped for c in all_connections),
+        }
+
+
+connections = Connections(heartbeat_interval=config.settings.ws_heartbeat_interval,
+                          idle_timeout=config.settings.ws_idle_timeout,
+                          tick=config.settings.ws_wheel_tick)
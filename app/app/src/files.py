@@ -0,0 +1,141 @@
+import mimetypes
+import os
+import stat
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from app.app.backend import config
+
+ZEROCOPY = "http.response.zerocopysend"
+
+# Sources never change once uploaded, so clients may keep them for good
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+# Stands in for something that is not ready yet, clients have to ask again
+REVALIDATE = "private, no-cache"
+
+
+# parse_range result for a well-formed range that lies outside the file, answered with 416
+UNSATISFIABLE = (-1, -1)
+
+
+def parse_range(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single "bytes=" range into inclusive (start, end). None means
+    the whole file should be sent, UNSATISFIABLE that it cannot be served.
+    Several ranges at once and malformed ones, including a last byte before
+    the first, are answered with the whole file.
+    """
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    first, _, last = value[len("bytes="):].strip().partition("-")
+    if not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if not first:
+        suffix = int(last)
+        return (max(size - suffix, 0), size - 1) if suffix > 0 else UNSATISFIABLE
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return UNSATISFIABLE
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def etag_matches(value: Optional[str], etag: str) -> bool:
+    if not value:
+        return False
+    tags: List[str] = [tag.strip() for tag in value.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class AttachmentResponse(Response):
+    """
+    Serves a stored file with a strong ETag made from its content hash,
+    answers If-None-Match with 304, single byte ranges with 206 and sends
+    large bodies with the zero-copy ASGI extension when the server has it
+    (uvicorn does not, it always gets the chunked path).
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: str, content_hash: str, filename: str, stat_result: Optional[os.stat_result] = None,
+                 cache_control: str = CACHE_CONTROL):
+        super().__init__(media_type=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        self.path = path
+        self.etag = f'"{content_hash}"'
+        self.filename = filename
+        self.stat_result = stat_result
+        self.cache_control = cache_control
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        request_headers = Headers(scope=scope)
+        headers = {"etag": self.etag, "cache-control": self.cache_control, "accept-ranges": "bytes"}
+        if etag_matches(request_headers.get("if-none-match"), self.etag):
+            await self._send_head(send, 304, headers)
+            return
+
+        if self.stat_result is None:
+            self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        if not stat.S_ISREG(self.stat_result.st_mode):
+            raise RuntimeError(f"File at path {self.path} is not a file.")
+        size = self.stat_result.st_size
+
+        status, start, end = 200, 0, size - 1
+        # A stale If-Range means the client's partial copy is of other content, it gets the whole file
+        if_range = request_headers.get("if-range")
+        if size and (if_range is None or if_range == self.etag):
+            byte_range = parse_range(request_headers.get("range"), size)
+            if byte_range is UNSATISFIABLE:
+                await self._send_head(send, 416, {**headers, "content-range": f"bytes */{size}"})
+                return
+            if byte_range is not None:
+                status, (start, end) = 206, byte_range
+                headers["content-range"] = f"bytes {start}-{end}/{size}"
+
+        quoted = quote(self.filename)
+        headers.update({
+            "content-type": self.media_type,
+            "content-length": str(end - start + 1 if size else 0),
+            "content-disposition": f'attachment; filename="{self.filename}"' if quoted == self.filename
+            else f"attachment; filename*=utf-8''{quoted}",
+        })
+        await self._send_head(send, status, headers, more_body=True)
+        if scope.get("method", "GET").upper() == "HEAD" or not size:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        count = end - start + 1
+        if ZEROCOPY in scope.get("extensions", {}) and count >= config.settings.download_zerocopy_min_size:
+            # Only servers that implement the extension get here, uvicorn never offers it
+            file = await anyio.to_thread.run_sync(open, self.path, "rb")
+            try:
+                await send({"type": ZEROCOPY, "file": file, "offset": start, "count": count, "more_body": False})
+            finally:
+                await anyio.to_thread.run_sync(file.close)
+            return
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(start)
+            while count:
+                chunk = await file.read(min(self.chunk_size, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+        if count:
+            # The file shrank under us, end the response anyway
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    @staticmethod
+    async def _send_head(send: Send, status: int, headers: dict, more_body: bool = False) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(key.encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()],
+        })
+        if not more_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+
+from app.app.backend import config
+from app.app.backend.chat import send_message, get_message_range, get_info, next_message_cursor, replay_messages, \
+    mark_read
+from app.app.backend.exceptions import PermissionDenied, ObjectNotFound, InvalidRange, Overloaded
+from app.app.src.connections import Connection
+from app.app.src.schemas.protocol import SendMessage, GetMessageRange, GetInfo, Ack, Resume
+from app.app.src.wire import Frame, decode
+
+log = logging.getLogger(__name__)
+
+ERRORS = {
+    PermissionDenied: (403, "Permission denied"),
+    ObjectNotFound: (404, "Resource wasn't found"),
+    InvalidRange: (400, "Invalid range"),
+    Overloaded: (503, "Server is busy, try again later"),
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+async def op_send_message(connection: Connection, payload: SendMessage) -> Any:
+    return await send_message(current_user=connection.user_id, chat_id=payload.chat_id, body=payload.body,
+                              attachments=payload.attachments, tags=payload.tags)
+
+
+async def op_get_message_range(connection: Connection, payload: GetMessageRange) -> Any:
+    limit = min(payload.limit, 500)
+    messages = await get_message_range(current_user=connection.user_id, chat_id=payload.chat_id, limit=limit,
+                                       before=payload.before, after=payload.after)
+    return {"messages": [dict(m) for m in messages],
+            "next_cursor": next_message_cursor(messages, limit, payload.after)}
+
+
+async def op_get_info(connection: Connection, payload: GetInfo) -> Any:
+    return await get_info(current_user=connection.user_id, chat_id=payload.chat_id)
+
+
+async def op_ack(connection: Connection, payload: Ack) -> Any:
+    if payload.seq <= connection.acked.get(payload.chat_id, 0):
+        return True
+    # The ack is the read cursor of the inbox as well
+    await mark_read(current_user=connection.user_id, chat_id=payload.chat_id, seq=payload.seq)
+    connection.acked[payload.chat_id] = payload.seq
+    return True
+
+
+async def op_resume(connection: Connection, payload: Resume) -> Any:
+    """
+    Replays what the client missed in each chat of `positions` ({chat_id: last
+    seen seq}). The frames go out as ordinary message frames ahead of the
+    response; chats that were not fully caught up have to be paged over
+    get_message_range.
+    """
+    result = {}
+    for chat_id, seq in payload.positions.items():
+        try:
+            frames, complete = await replay_messages(connection.user_id, chat_id, seq, config.settings.replay_db_limit)
+        except PermissionDenied:
+            result[chat_id] = {"error": 403}
+            continue
+        for frame in frames:
+            connection.send(frame)
+        result[chat_id] = {"replayed": len(frames), "complete": complete}
+    return result
+
+
+# Every op with the model its payload is validated against before it runs
+OPS: Dict[str, Tuple[Callable[[Connection, Any], Awaitable[Any]], Type[BaseModel]]] = {
+    "send_message": (op_send_message, SendMessage),
+    "get_message_range": (op_get_message_range, GetMessageRange),
+    "get_info": (op_get_info, GetInfo),
+    "ack": (op_ack, Ack),
+    "resume": (op_resume, Resume),
+}
+
+
+def validate_payload(model: Type[BaseModel], payload: Any) -> BaseModel:
+    try:
+        return model.parse_obj(payload if payload is not None else {})
+    except ValidationError as e:
+        fields = ", ".join(".".join(str(part) for part in error["loc"]) for error in e.errors())
+        raise BadRequest(f"Malformed payload: {fields}")
+
+
+async def handle_request(connection: Connection, request: Dict[str, Any]) -> None:
+    request_id = request.get("id")
+    try:
+        if (entry := OPS.get(request.get("op"))) is None:
+            raise BadRequest(f"Unknown op '{request.get('op')}'")
+        op, model = entry
+        result = await op(connection, validate_payload(model, request.get("payload")))
+        response = {"id": request_id, "ok": True, "result": result}
+    except BadRequest as e:
+        response = {"id": request_id, "ok": False, "error": {"status": 400, "detail": str(e)}}
+    except tuple(ERRORS) as e:
+        status, detail = ERRORS[type(e)]
+        response = {"id": request_id, "ok": False, "error": {"status": status, "detail": detail}}
+    except Exception:
+        log.exception(f"Websocket request {request_id} failed")
+        response = {"id": request_id, "ok": False, "error": {"status": 500, "detail": "Internal error"}}
+    connection.send(Frame(response))
+
+
+class RequestPipeline:
+    """
+    Runs the requests of one connection concurrently, at most `max_in_flight`
+    at a time. Responses carry the request id and may arrive in any order.
+    """
+
+    def __init__(self, connection: Connection, max_in_flight: int = 16):
+        self.connection = connection
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+
+    async def receive(self, data) -> None:
+        self.connection.touch()
+        try:
+            request = decode(data, self.connection.encoding)
+            if not isinstance(request, dict):
+                raise ValueError()
+        except Exception:
+            self.connection.send(Frame({"id": None, "ok": False,
+                                        "error": {"status": 400, "detail": "Malformed frame"}}))
+            return
+        if request.get("op") == "pong":
+            # Heartbeat answer; a client may also send one unprompted to opt into the heartbeat
+            self.connection.heartbeat = True
+            return
+        await self.submit(request)
+
+    async def submit(self, request: Dict[str, Any]) -> None:
+        # Waiting here applies backpressure to a client that pipelines too much
+        await self._semaphore.acquire()
+        task = asyncio.ensure_future(handle_request(self.connection, request))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._semaphore.release()
+
+    def cancel(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
@@ -0,0 +1,32 @@
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, conint
+
+
+class SendMessage(BaseModel):
+    chat_id: int
+    body: str
+    attachments: List[str] = []
+    tags: Optional[List[str]] = None
+
+
+class GetMessageRange(BaseModel):
+    chat_id: int
+    # Larger pages are cut to 500 by the op, non-positive ones never reach SQL
+    limit: conint(ge=1) = 50
+    before: Optional[str] = None
+    after: Optional[str] = None
+
+
+class GetInfo(BaseModel):
+    chat_id: int
+
+
+class Ack(BaseModel):
+    chat_id: int
+    seq: conint(ge=0)
+
+
+class Resume(BaseModel):
+    # {chat_id: seq of the last message the client has}
+    positions: Dict[int, conint(ge=0)]
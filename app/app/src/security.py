@@ -10,7 +10,7 @@ from passlib.context import CryptContext
 from starlette import status
 from app.app import inital_data
 from app.app.backend.exceptions import ObjectNotFound
-from app.app.backend.user import get_user_info
+from app.app.backend.user import get_identity
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -40,7 +40,7 @@ async def decode_token(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
     try:
-        user = await get_user_info(current_user=user_id, user_id=user_id)
+        user = await get_identity(user_id)
     except ObjectNotFound:
         raise credentials_exception
     if user is None:
@@ -6,29 +6,23 @@ import asyncio
 from fastapi import WebSocket
 from starlette.endpoints import WebSocketEndpoint
 
+from app.app.backend import config
+from app.app.src.connections import connections
+from app.app.src.protocol import RequestPipeline
 from app.app.src.security import decode_token
+from app.app.src.wire import negotiate
 
 log = logging.getLogger(__name__)
 
 
-class Connections:
-    def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
-
-    def add_user(self, user_id: int, websocket: WebSocket):
-        self.active_connections.update({user_id: websocket})
-
-    def remove_user(self, user_id: int):
-        self.active_connections.pop(user_id)
-
-
-connections = Connections()
-
-
 class ConnectionManager(WebSocketEndpoint):
+    # Frames are decoded by the request pipeline with the negotiated encoding
+    encoding = None
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.connection = None
+        self.pipeline = None
 
     async def on_connect(self, websocket, ):
         log.info("Connecting new user...")
@@ -41,27 +35,34 @@ class ConnectionManager(WebSocketEndpoint):
 
         user_id = await decode_token(websocket.headers["Authorization"])
         user_id = user_id["id"]
-        await websocket.accept()
-
-        connections.add_user(user_id, websocket)
+        # Clients pick the frame encoding with the websocket subprotocol or the "encoding" query parameter
+        requested = websocket.scope.get("subprotocols") or [websocket.query_params.get("encoding")]
+        encoding = negotiate(requested)
+        await websocket.accept(subprotocol=encoding if encoding in websocket.scope.get("subprotocols", ()) else None)
+
+        # "?heartbeat=1" opts into JSON pings; clients that only listen are reaped by protocol-level pings
+        heartbeat = websocket.query_params.get("heartbeat") in ("1", "true")
+        self.connection = connections.add_user(user_id, websocket, encoding, heartbeat=heartbeat)
+        self.pipeline = RequestPipeline(self.connection, config.settings.ws_max_inflight)
+        # "?resume=<chat_id>:<seq>,..." replays what was missed while disconnected, like the resume op
+        if resume := websocket.query_params.get("resume"):
+            try:
+                positions = dict(position.split(":") for position in resume.split(","))
+            except ValueError:
+                positions = {}
+            await self.pipeline.submit({"id": "resume", "op": "resume", "payload": {"positions": positions}})
         log.info(connections.active_connections)
 
     async def on_disconnect(self, _websocket: WebSocket, _close_code: int):
-        user_id = await decode_token(_websocket.headers["Authorization"])
-        user_id = user_id["id"]
-
-        connections.remove_user(user_id)
-        log.info(f'{user_id} has been disconnected')
-        await _websocket.close()
-
-    async def on_receive(self, _websocket: WebSocket, msg: str):
-        pass
-        # log.info("receive")
-        # log.info(msg)
-        # if msg is not None:
-        #     await _websocket.send_json(msg)
-        #     user_id = await get_user_info(current_user=1, user_nick="pl")
-        #     await _websocket.send_json(user_id)
+        # The identity was captured at accept time, no need to decode the token again
+        if self.connection is None:
+            return
+        self.pipeline.cancel()
+        connections.remove(self.connection)
+        log.info(f'{self.connection.user_id} has been disconnected')
+
+    async def on_receive(self, _websocket: WebSocket, msg):
+        await self.pipeline.receive(msg)
 
 
 async def bug():
@@ -0,0 +1,53 @@
+import json
+from typing import Any, Dict, Optional
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is optional, every client understands JSON
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+
+def available_encodings():
+    return (MSGPACK, JSON) if msgpack is not None else (JSON,)
+
+
+def negotiate(requested) -> str:
+    for encoding in requested or ():
+        if encoding in available_encodings():
+            return encoding
+    return JSON
+
+
+class Frame:
+    """
+    A payload sent to many websockets. Each encoding is produced at most once
+    and the same bytes are shared by every recipient that negotiated it.
+    """
+
+    __slots__ = ("payload", "_encoded")
+
+    def __init__(self, payload: Dict[str, Any]):
+        self.payload = payload
+        self._encoded: Dict[str, bytes] = {}
+
+    def encode(self, encoding: str = JSON) -> bytes:
+        if (data := self._encoded.get(encoding)) is None:
+            if encoding == MSGPACK:
+                data = msgpack.packb(self.payload, default=str, use_bin_type=True)
+            else:
+                data = json.dumps(self.payload, separators=(",", ":"), default=str).encode()
+            self._encoded[encoding] = data
+        return data
+
+    @property
+    def json(self) -> str:
+        return self.encode(JSON).decode()
+
+
+def decode(data, encoding: str = JSON) -> Optional[Any]:
+    if encoding == MSGPACK and isinstance(data, bytes):
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
@@ -0,0 +1,40 @@
+"""
+Deletes the stored contents no source refers to any more, with their
+previews. Only blobs older than --min-age hours are deleted, and a file
+uploaded again within that time stays on disk. Safe to run next to a
+running server, e.g. daily from cron. Run from the repository root:
+
+    python -m app.app.sweep_blobs [--min-age 24]
+"""
+import argparse
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from app.app.backend import config
+from app.app.backend import init as init_db
+from app.app.backend.storage import sweep_blobs
+from app.app.settings import Settings
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Delete stored contents no source refers to")
+    parser.add_argument("--min-age", type=float, default=24.0, help="hours since a blob was stored")
+    args = parser.parse_args()
+    dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+    if os.path.exists(dotenv_path):
+        load_dotenv(dotenv_path)
+    await init_db(settings=Settings())
+    try:
+        log.info(f"Done: {await sweep_blobs(args.min_age * 3600)} unused blobs deleted")
+    finally:
+        await config.db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+import asyncio
+import json
+
+import pytest
+
+from app.app.backend import config
+from app.app.backend.bus import DeliveryBus, LocalTransport, PostgresTransport, NODE
+from app.app.backend.cache import identity_cache
+from app.app.backend.user import __on_user_event__
+
+
+@pytest.mark.asyncio
+async def test_events_reach_handlers():
+    bus = DeliveryBus(LocalTransport())
+    received = []
+
+    async def on_message(event):
+        received.append(event)
+
+    bus.on("message", on_message)
+    await bus.start()
+    await bus.publish("message", m=1, c=2)
+    await bus.publish("unknown", x=1)
+    await bus.close()
+    assert received == [{"n": NODE, "m": 1, "c": 2}]
+    assert bus.published == bus.received == 2
+
+
+@pytest.mark.asyncio
+async def test_failing_handler_is_counted():
+    bus = DeliveryBus(LocalTransport())
+
+    async def broken(event):
+        raise RuntimeError()
+
+    bus.on("chat", broken)
+    await bus.publish("chat", c=1)
+    assert bus.failed == 1
+
+
+class FakeListener:
+    def add_termination_listener(self, _callback):
+        pass
+
+    async def add_listener(self, _channel, _callback):
+        pass
+
+    async def remove_listener(self, _channel, _callback):
+        pass
+
+
+class FakePool:
+    async def acquire(self):
+        return FakeListener()
+
+    async def release(self, _connection):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_notifications_are_bounded(monkeypatch):
+    monkeypatch.setattr(config, "db", FakePool())
+    transport = PostgresTransport(queue_size=2, workers=1)
+    handled, release = [], asyncio.Event()
+
+    async def on_payload(payload):
+        await release.wait()
+        handled.append(payload)
+
+    await transport.start(on_payload)
+    transport._on_notify(None, 0, transport.channel, "0")
+    await asyncio.sleep(0.01)
+    for i in range(1, 4):
+        transport._on_notify(None, 0, transport.channel, str(i))
+    # One payload is being handled, two wait in the queue and the last one is dropped
+    assert transport.stats() == {"queued": 2, "dropped": 1}
+    release.set()
+    await transport.join()
+    assert handled == ["0", "1", "2"]
+    await transport.close()
+
+
+@pytest.mark.asyncio
+async def test_events_of_a_chat_keep_their_order(monkeypatch):
+    monkeypatch.setattr(config, "db", FakePool())
+    transport = PostgresTransport(workers=4)
+    sent = []
+
+    async def on_payload(payload):
+        event = json.loads(payload)
+        # Later events of a chat finish sooner, a shared queue would reorder them
+        await asyncio.sleep(0.001 * (10 - event["s"]))
+        sent.append((event["c"], event["s"]))
+
+    await transport.start(on_payload)
+    for seq in range(10):
+        for chat_id in (1, 2):
+            transport._on_notify(None, 0, transport.channel, json.dumps({"t": "message", "c": chat_id, "s": seq}))
+    await transport.join()
+    await transport.close()
+    for chat_id in (1, 2):
+        assert [seq for chat, seq in sent if chat == chat_id] == list(range(10))
+
+
+@pytest.mark.asyncio
+async def test_identity_changes_reach_other_processes():
+    identity_cache.put(42, {"id": 42, "nick": "old"})
+    await __on_user_event__({"n": NODE, "u": 42})
+    assert 42 in identity_cache
+    await __on_user_event__({"n": "another-node", "u": 42})
+    assert 42 not in identity_cache
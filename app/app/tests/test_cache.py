@@ -0,0 +1,92 @@
+from app.app.backend import cache
+from app.app.backend.cache import TTLCache
+
+
+def test_ttl_cache_hit_and_miss():
+    c = TTLCache(maxsize=10, ttl=60)
+    assert c.get(1) is None
+    c.put(1, {"id": 1})
+    assert c.get(1) == {"id": 1}
+    assert c.hits == 1 and c.misses == 1
+    assert c.hit_rate() == 0.5
+
+
+def test_ttl_cache_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    c = TTLCache(maxsize=10, ttl=5)
+    c.put("a", 1)
+    now[0] += 4
+    assert c.get("a") == 1
+    now[0] += 2
+    assert c.get("a") is None
+    assert len(c) == 0
+
+
+def test_ttl_cache_lru_bound():
+    c = TTLCache(maxsize=2, ttl=60)
+    c.put(1, "a")
+    c.put(2, "b")
+    c.get(1)
+    c.put(3, "c")
+    assert 1 in c and 3 in c
+    assert 2 not in c
+
+
+def test_ttl_cache_invalidate():
+    c = TTLCache(maxsize=2, ttl=60)
+    c.put(1, "a")
+    c.invalidate(1)
+    c.invalidate(2)
+    assert c.get(1) is None
+
+
+def test_chat_tokens_cache_invalidation():
+    c = cache.ChatTokensCache(maxsize=10, ttl=60)
+    c.put_tokens(1, [10, 11], {10: ["a"], 11: ["b"]})
+    c.put_tokens(2, [11, 12], {11: ["b"], 12: ["c"]})
+    assert c.get_tokens(1, [11, 10]) == {10: ["a"], 11: ["b"]}
+    assert c.get_tokens(1, [10]) is None
+    c.forget_user(10)
+    assert c.get_tokens(1, [10, 11]) is None
+    assert c.get_tokens(2, [11, 12]) is not None
+    c.forget_tokens(["c"])
+    assert c.get_tokens(2, [11, 12]) is None
+
+
+def test_chat_tokens_index_follows_evictions():
+    c = cache.ChatTokensCache(maxsize=2, ttl=60)
+    c.put_tokens(1, [10], {10: ["a"]})
+    c.put_tokens(1, [11], {11: ["b"]})
+    c.put_tokens(2, [11], {11: ["b"]})
+    c.put_tokens(3, [12], {12: ["c"]})
+    # Chat 1 was replaced and then evicted, none of its users or tokens point at it
+    assert c._by_user == {11: {2}, 12: {3}}
+    assert c._by_token == {"b": {2}, "c": {3}}
+    c.forget_user(11)
+    c.invalidate(3)
+    assert c._by_user == c._by_token == {}
+
+
+def test_versioned_cache_rejects_stale_fill():
+    c = cache.VersionedCache(maxsize=10, ttl=60)
+    version = c.version(1)
+    c.bump(1)
+    c.put_versioned(1, version, "stale")
+    assert c.get_current(1) is None
+    c.put_versioned(1, c.version(1), "fresh")
+    assert c.get_current(1) == "fresh"
+    c.bump(1)
+    assert c.get_current(1) is None
+
+
+def test_membership_index_updates_in_place():
+    index = cache.MembershipIndex(maxsize=10, ttl=60)
+    index.set_member(1, 10, False)
+    assert index.get_current(1) is None
+    index.put_versioned(1, index.version(1), {10: True})
+    index.set_member(1, 11, False)
+    assert index.get_current(1) == {10: True, 11: False}
+    index.set_member(1, 11, True)
+    index.discard_member(1, 10)
+    assert index.get_current(1) == {11: True}
@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+from app.app.src.connections import Connection, Connections, TimerWheel, DROP_OLDEST, DISCONNECT, COALESCE, \
+    RESYNC_FRAME, PING_FRAME
+
+
+class FakeWebSocket:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.frames = []
+        self.closed_with = None
+
+    async def send_bytes(self, data):
+        await asyncio.sleep(self.delay)
+        self.frames.append(data)
+
+    async def send_text(self, data):
+        await self.send_bytes(data)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+@pytest.mark.asyncio
+async def test_many_sockets_per_user():
+    registry = Connections()
+    first, second = FakeWebSocket(), FakeWebSocket()
+    registry.add_user(1, first)
+    registry.add_user(1, second)
+    assert registry.send_to_user(1, b"hello") == 2
+    await asyncio.sleep(0.01)
+    assert first.frames == second.frames == [b"hello"]
+    registry.remove_user(1, first)
+    assert registry.send_to_user(1, b"again") == 1
+    await asyncio.sleep(0.01)
+    assert first.frames == [b"hello"]
+    assert second.frames == [b"hello", b"again"]
+
+
+@pytest.mark.asyncio
+async def test_slow_client_does_not_block_others():
+    registry = Connections()
+    slow, fast = FakeWebSocket(delay=1), FakeWebSocket()
+    registry.add_user(1, slow)
+    registry.add_user(2, fast)
+    registry.send_to_user(1, b"x")
+    registry.send_to_user(2, b"x")
+    await asyncio.sleep(0.01)
+    assert fast.frames == [b"x"]
+    assert slow.frames == []
+    registry.remove_user(1, slow)
+
+
+async def _fill(policy):
+    ws = FakeWebSocket(delay=1)
+    connection = Connection(1, ws, queue_size=2, policy=policy)
+    for i in range(4):
+        connection.send(str(i).encode())
+    return connection, ws
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_policy():
+    connection, _ = await _fill(DROP_OLDEST)
+    assert list(connection._queue) == [b"2", b"3"]
+    assert connection.dropped == 2
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy():
+    connection, ws = await _fill(DISCONNECT)
+    await asyncio.sleep(0)
+    assert connection.closed
+    assert ws.closed_with == 1008
+
+
+@pytest.mark.asyncio
+async def test_coalesce_policy():
+    connection, _ = await _fill(COALESCE)
+    assert list(connection._queue) == [RESYNC_FRAME.encode(), b"3"]
+
+
+def test_timer_wheel_reschedules_and_drops():
+    seen = []
+
+    def on_expire(item):
+        seen.append(item)
+        return 2 if item == "again" else None
+
+    wheel = TimerWheel(on_expire, tick=1, slots=4)
+    wheel.schedule("once", 1)
+    wheel.schedule("again", 2)
+    wheel.schedule("gone", 1)
+    wheel.discard("gone")
+    for _ in range(4):
+        wheel.advance()
+    assert seen == ["once", "again", "again"]
+    assert len(wheel) == 1
+
+
+@pytest.mark.asyncio
+async def test_idle_connections_are_pinged_then_reaped():
+    registry = Connections(heartbeat_interval=30, idle_timeout=75)
+    quiet, chatty = FakeWebSocket(), FakeWebSocket()
+    quiet_connection = registry.add_user(1, quiet, heartbeat=True)
+    chatty_connection = registry.add_user(2, chatty, heartbeat=True)
+    quiet_connection.last_seen -= 40
+    assert registry._check(quiet_connection) == 30
+    assert registry._check(chatty_connection) == 30
+    await asyncio.sleep(0.01)
+    assert quiet.frames == [PING_FRAME.encode()]
+    assert chatty.frames == []
+    assert registry.stats()["idle"] == 1
+
+    quiet_connection.last_seen -= 40
+    assert registry._check(quiet_connection) is None
+    await asyncio.sleep(0.01)
+    assert quiet.closed_with is not None
+    assert 1 not in registry.active_connections
+    assert registry.stats()["reaped"] == 1
+    assert registry.stats()["live"] == 1
+    await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_listen_only_connections_are_not_reaped():
+    registry = Connections(heartbeat_interval=30, idle_timeout=75)
+    listener = FakeWebSocket()
+    connection = registry.add_user(1, listener)
+    connection.last_seen -= 200
+    assert registry._check(connection) == 30
+    await asyncio.sleep(0.01)
+    assert listener.frames == []
+    assert listener.closed_with is None
+    assert registry.stats()["idle"] == 0
+    # An unprompted pong opts the connection into the heartbeat
+    connection.heartbeat = True
+    assert registry._check(connection) is None
+    assert registry.stats()["reaped"] == 1
+    await registry.close()
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from app.app.backend.fanout import FanOut, BLOCK, DROP_NEWEST, DROP_OLDEST
+
+
+@pytest.mark.asyncio
+async def test_jobs_run_off_the_caller():
+    fanout = FanOut(workers=2)
+    done = []
+
+    async def job():
+        done.append(1)
+
+    assert await fanout.submit(job)
+    assert done == []
+    await fanout.join()
+    await fanout.close()
+    assert done == [1]
+    assert fanout.completed == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("overflow, expected", [(DROP_NEWEST, [0, 1]), (DROP_OLDEST, [1, 2])])
+async def test_overflow_policy(overflow, expected, caplog):
+    fanout = FanOut(queue_size=2, workers=1, overflow=overflow)
+    done = []
+    fanout.start()
+    for i in range(3):
+        await fanout.submit(lambda i=i: asyncio.sleep(0, done.append(i)), label=f"delivery of message {i}")
+    await fanout.join()
+    await fanout.close()
+    assert done == expected
+    assert fanout.dropped == 1
+    dropped = ({0, 1, 2} - set(expected)).pop()
+    assert f"dropping delivery of message {dropped}" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_full_queue_blocks_the_producer(caplog):
+    fanout = FanOut(queue_size=1, workers=1, overflow=BLOCK, timeout=0.05)
+    done, release = [], asyncio.Event()
+
+    async def job(i):
+        await release.wait()
+        done.append(i)
+
+    for i in range(2):
+        assert await fanout.submit(lambda i=i: job(i))
+    # The first job is running, the second fills the queue, the third waits and gives up
+    assert not await fanout.submit(lambda: job(2), label="delivery of message 2")
+    assert "dropping delivery of message 2" in caplog.text
+    waiting = asyncio.ensure_future(fanout.submit(lambda: job(3)))
+    release.set()
+    assert await waiting
+    await fanout.join()
+    await fanout.close()
+    assert done == [0, 1, 3]
+    assert fanout.dropped == 1
+
+
+
+@pytest.mark.asyncio
+async def test_jobs_of_a_chat_keep_their_order():
+    fanout = FanOut(workers=4)
+    sent = []
+
+    async def deliver(chat_id, seq):
+        await asyncio.sleep(0.001 * (10 - seq))
+        sent.append((chat_id, seq))
+
+    for seq in range(10):
+        for chat_id in (1, 2):
+            await fanout.submit(lambda chat_id=chat_id, seq=seq: deliver(chat_id, seq), key=chat_id)
+    await fanout.join()
+    await fanout.close()
+    for chat_id in (1, 2):
+        assert [seq for chat, seq in sent if chat == chat_id] == list(range(10))
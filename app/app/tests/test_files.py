@@ -0,0 +1,87 @@
+import pytest
+
+from app.app.src.files import AttachmentResponse, parse_range, etag_matches, ZEROCOPY, UNSATISFIABLE
+
+DATA = bytes(range(256)) * 40
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    assert parse_range("items=0-1", 100) is None
+    assert parse_range("bytes=a-b", 100) is None
+    assert parse_range("bytes=--5", 100) is None
+    assert parse_range("bytes=100-", 100) is UNSATISFIABLE
+    assert parse_range("bytes=5-3", 100) is None
+    assert parse_range("bytes=500-3", 100) is None
+    assert parse_range("bytes=-0", 100) is UNSATISFIABLE
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc"', '"abc"')
+    assert etag_matches("*", '"abc"')
+    assert not etag_matches('"x"', '"abc"')
+    assert not etag_matches(None, '"abc"')
+
+
+async def serve(path, headers=(), method="GET", extensions=None):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": method, "headers": [(k.encode(), v.encode()) for k, v in headers],
+             "extensions": extensions or {}}
+    await AttachmentResponse(str(path), "abc", "clip.mp4")(scope, None, send)
+    start = messages[0]
+    return start["status"], {k.decode(): v.decode() for k, v in start["headers"]}, messages[1:]
+
+
+@pytest.fixture
+def stored(tmp_path):
+    path = tmp_path / "abc"
+    path.write_bytes(DATA)
+    return path
+
+
+@pytest.mark.asyncio
+async def test_full_download(stored):
+    status, headers, body = await serve(stored)
+    assert status == 200
+    assert headers["etag"] == '"abc"'
+    assert headers["content-type"] == "video/mp4"
+    assert headers["content-length"] == str(len(DATA))
+    assert b"".join(m["body"] for m in body) == DATA
+    assert not body[-1]["more_body"]
+
+
+@pytest.mark.asyncio
+async def test_range_and_conditional_requests(stored):
+    status, headers, body = await serve(stored, [("range", "bytes=100-199")])
+    assert status == 206
+    assert headers["content-range"] == f"bytes 100-199/{len(DATA)}"
+    assert b"".join(m["body"] for m in body) == DATA[100:200]
+
+    status, _, body = await serve(stored, [("if-none-match", '"abc"')])
+    assert status == 304 and body == [{"type": "http.response.body", "body": b"", "more_body": False}]
+
+    status, _, _ = await serve(stored, [("range", "bytes=100-199"), ("if-range", '"old"')])
+    assert status == 200
+
+    status, headers, _ = await serve(stored, [("range", f"bytes={len(DATA)}-")])
+    assert status == 416 and headers["content-range"] == f"bytes */{len(DATA)}"
+
+
+@pytest.mark.asyncio
+async def test_zero_copy_when_offered(stored, monkeypatch):
+    from app.app.backend import config
+    monkeypatch.setattr(config.settings, "download_zerocopy_min_size", 1)
+    status, _, body = await serve(stored, [("range", "bytes=10-")], extensions={ZEROCOPY: {}})
+    assert status == 206
+    assert body[0]["type"] == ZEROCOPY
+    assert (body[0]["offset"], body[0]["count"]) == (10, len(DATA) - 10)
@@ -0,0 +1,33 @@
+import asyncio
+import time
+
+import pytest
+
+from app.app.backend.exceptions import Overloaded
+from app.app.backend.hashing import HashingPool, _timed_hash, _timed_verify
+
+
+def _slow(value, submitted):
+    time.sleep(0.05)
+    return value, time.time() - submitted, 0.05
+
+
+@pytest.mark.asyncio
+async def test_hash_and_verify():
+    pool = HashingPool("thread", 1, 1)
+    password_hash = await pool.run(_timed_hash, "secret")
+    assert await pool.run(_timed_verify, "secret", password_hash)
+    assert not await pool.run(_timed_verify, "wrong", password_hash)
+    assert pool.stats()["completed"] == 3
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_saturated():
+    pool = HashingPool("thread", 1, 1)
+    results = await asyncio.gather(*(pool.run(_slow, i) for i in range(3)), return_exceptions=True)
+    assert results[:2] == [0, 1]
+    assert isinstance(results[2], Overloaded)
+    assert pool.rejected == 1
+    assert pool.queue_wait_max > 0
+    pool.shutdown()
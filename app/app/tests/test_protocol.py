@@ -0,0 +1,115 @@
+import asyncio
+import json
+
+import pytest
+from pydantic import BaseModel
+
+from app.app.backend.exceptions import PermissionDenied
+from app.app.src import protocol
+from app.app.src.connections import Connection
+from app.app.src.protocol import RequestPipeline
+from app.app.src.schemas.protocol import GetInfo
+from app.app.src.wire import Frame
+from app.app.tests.test_connections import FakeWebSocket
+
+
+async def responses(websocket: FakeWebSocket):
+    await asyncio.sleep(0.05)
+    return [json.loads(frame) for frame in websocket.frames]
+
+
+@pytest.mark.asyncio
+async def test_ack_and_unknown_op(monkeypatch):
+    marked = []
+
+    async def mark_read(current_user, chat_id, seq):
+        marked.append((current_user, chat_id, seq))
+        return True
+
+    monkeypatch.setattr(protocol, "mark_read", mark_read)
+    websocket = FakeWebSocket()
+    connection = Connection(7, websocket)
+    connection.start()
+    pipeline = RequestPipeline(connection)
+    await pipeline.receive(json.dumps({"id": 1, "op": "ack", "payload": {"chat_id": 3, "seq": 10}}))
+    await pipeline.receive(json.dumps({"id": 2, "op": "ack", "payload": {"chat_id": 3, "seq": 4}}))
+    await pipeline.receive(json.dumps({"id": 3, "op": "nope"}))
+    await pipeline.receive("not json")
+    assert not connection.heartbeat
+    await pipeline.receive(json.dumps({"op": "pong"}))
+    assert connection.heartbeat
+    result = {r["id"]: r for r in await responses(websocket)}
+    assert result[1] == {"id": 1, "ok": True, "result": True}
+    assert result[3]["error"]["status"] == 400
+    assert result[None] == {"id": None, "ok": False, "error": {"status": 400, "detail": "Malformed frame"}}
+    assert connection.acked == {3: 10}
+    # Stale acks do not reach the database
+    assert marked == [(7, 3, 10)]
+
+
+@pytest.mark.asyncio
+async def test_errors_are_mapped(monkeypatch):
+    async def forbidden(_connection, _payload):
+        raise PermissionDenied()
+
+    async def buggy(_connection, payload):
+        return {}["missing"]
+
+    monkeypatch.setitem(protocol.OPS, "forbidden", (forbidden, GetInfo))
+    monkeypatch.setitem(protocol.OPS, "buggy", (buggy, GetInfo))
+    websocket = FakeWebSocket()
+    connection = Connection(7, websocket)
+    connection.start()
+    pipeline = RequestPipeline(connection)
+    await pipeline.receive(json.dumps({"id": "a", "op": "forbidden", "payload": {"chat_id": 1}}))
+    await pipeline.receive(json.dumps({"id": "b", "op": "forbidden", "payload": {"chat_id": "x"}}))
+    await pipeline.receive(json.dumps({"id": "c", "op": "ack", "payload": {"chat_id": 1, "seq": -1}}))
+    await pipeline.receive(json.dumps({"id": "d", "op": "buggy", "payload": {"chat_id": 1}}))
+    await pipeline.receive(json.dumps({"id": "e", "op": "get_message_range", "payload": {"chat_id": 1, "limit": -1}}))
+    result = {r["id"]: r for r in await responses(websocket)}
+    assert result["a"]["error"]["status"] == 403
+    assert result["b"]["error"] == {"status": 400, "detail": "Malformed payload: chat_id"}
+    assert result["c"]["error"] == {"status": 400, "detail": "Malformed payload: seq"}
+    assert result["e"]["error"] == {"status": 400, "detail": "Malformed payload: limit"}
+    # A bug in a handler is an internal error, not the client's fault
+    assert result["d"]["error"]["status"] == 500
+
+
+class Delay(BaseModel):
+    delay: float
+
+
+@pytest.mark.asyncio
+async def test_requests_are_pipelined(monkeypatch):
+    async def sleep(_connection, payload):
+        await asyncio.sleep(payload.delay)
+        return payload.delay
+
+    monkeypatch.setitem(protocol.OPS, "sleep", (sleep, Delay))
+    websocket = FakeWebSocket()
+    connection = Connection(7, websocket)
+    connection.start()
+    pipeline = RequestPipeline(connection, max_in_flight=4)
+    await pipeline.receive(json.dumps({"id": 1, "op": "sleep", "payload": {"delay": 0.03}}))
+    await pipeline.receive(json.dumps({"id": 2, "op": "sleep", "payload": {"delay": 0}}))
+    # The slow request does not hold back the fast one
+    assert [r["id"] for r in await responses(websocket)] == [2, 1]
+
+
+@pytest.mark.asyncio
+async def test_resume_replays_before_responding(monkeypatch):
+    async def replay_messages(current_user, chat_id, last_seq, limit):
+        if chat_id == 2:
+            raise PermissionDenied()
+        return [Frame({"seq": last_seq + 1}), Frame({"seq": last_seq + 2})], chat_id == 1
+
+    monkeypatch.setattr(protocol, "replay_messages", replay_messages)
+    websocket = FakeWebSocket()
+    connection = Connection(7, websocket)
+    connection.start()
+    pipeline = RequestPipeline(connection)
+    await pipeline.receive(json.dumps({"id": 1, "op": "resume", "payload": {"positions": {"1": 5, "2": 0, "3": 9}}}))
+    result = await responses(websocket)
+    assert [r.get("seq") for r in result[:4]] == [6, 7, 10, 11]
+    assert result[4]["result"] == {"1": {"replayed": 2, "complete": True}, "2": {"error": 403},
+                                   "3": {"replayed": 2, "complete": False}}
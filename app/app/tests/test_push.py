@@ -0,0 +1,53 @@
+import pytest
+
+from app.app.backend.push import FakeTransport, PushGateway, PushNotification, MULTICAST_LIMIT
+
+
+def make_gateway(transport, pruned):
+    async def on_dead_tokens(tokens):
+        pruned.extend(tokens)
+
+    return PushGateway(transport=transport, workers=2, threads=2, retry_backoff=0, on_dead_tokens=on_dead_tokens)
+
+
+@pytest.mark.asyncio
+async def test_empty_token_list_is_not_sent():
+    transport = FakeTransport()
+    gateway = make_gateway(transport, [])
+    assert not gateway.enqueue(PushNotification("chat", "hi", {}, []))
+    assert transport.sent == []
+
+
+@pytest.mark.asyncio
+async def test_tokens_are_chunked_to_multicast_limit():
+    transport = FakeTransport()
+    gateway = make_gateway(transport, [])
+    tokens = [f"t{i}" for i in range(MULTICAST_LIMIT * 2 + 1)]
+    assert gateway.enqueue(PushNotification("chat", "hi", {}, tokens))
+    await gateway.join()
+    await gateway.close()
+    assert sorted(len(n.tokens) for n in transport.sent) == [1, MULTICAST_LIMIT, MULTICAST_LIMIT]
+    assert gateway.sent == len(tokens)
+
+
+@pytest.mark.asyncio
+async def test_unregistered_tokens_are_pruned():
+    pruned = []
+    transport = FakeTransport(dead_tokens=["dead"])
+    gateway = make_gateway(transport, pruned)
+    gateway.enqueue(PushNotification("chat", "hi", {}, ["alive", "dead"]))
+    await gateway.join()
+    await gateway.close()
+    assert pruned == ["dead"]
+    assert gateway.sent == 1
+
+
+@pytest.mark.asyncio
+async def test_unavailable_transport_is_retried():
+    transport = FakeTransport(failures=2)
+    gateway = make_gateway(transport, [])
+    gateway.enqueue(PushNotification("chat", "hi", {}, ["a"]))
+    await gateway.join()
+    await gateway.close()
+    assert gateway.retried == 2
+    assert transport.sent[0].attempt == 2
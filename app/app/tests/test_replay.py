@@ -0,0 +1,67 @@
+from app.app.backend.replay import ReplayBuffer
+
+
+def test_replays_contiguous_frames():
+    buffer = ReplayBuffer(size=4)
+    for seq in range(1, 4):
+        buffer.record(10, seq, f"frame {seq}")
+    assert buffer.since(10, 1) == ["frame 2", "frame 3"]
+    assert buffer.since(10, 3) == []
+
+
+def test_gap_falls_back():
+    buffer = ReplayBuffer(size=4)
+    buffer.record(10, 1, "frame 1")
+    # Announced but never hydrated here
+    buffer.advance(10, 2)
+    buffer.record(10, 3, "frame 3")
+    assert buffer.since(10, 0) is None
+    assert buffer.since(10, 2) == ["frame 3"]
+    assert buffer.since(11, 0) is None
+
+
+def test_evicted_frames_fall_back():
+    buffer = ReplayBuffer(size=2)
+    for seq in range(1, 5):
+        buffer.record(10, seq, seq)
+    assert buffer.since(10, 2) == [3, 4]
+    assert buffer.since(10, 1) is None
+    assert buffer.stats()["misses"] == 1
+
+
+def test_out_of_order_records():
+    buffer = ReplayBuffer(size=4)
+    buffer.advance(10, 2)
+    buffer.record(10, 2, "frame 2")
+    assert buffer.since(10, 0) is None
+    buffer.record(10, 1, "frame 1")
+    assert buffer.since(10, 0) == ["frame 1", "frame 2"]
+
+
+def test_chats_are_bounded():
+    buffer = ReplayBuffer(chats=2)
+    for chat_id in range(3):
+        buffer.record(chat_id, 1, "frame")
+    assert buffer.since(0, 0) is None
+    assert buffer.since(2, 0) == ["frame"]
+
+
+def test_missed_events_fall_back():
+    buffer = ReplayBuffer(size=4)
+    buffer.record(10, 1, "frame 1")
+    # Seq 2 was committed but its event never reached this process
+    assert buffer.since(10, 0, head=2) is None
+    assert buffer.since(10, 1, head=2) is None
+    assert buffer.since(10, 0, head=1) is None
+    buffer.record(10, 2, "frame 2")
+    assert buffer.since(10, 0, head=2) == ["frame 1", "frame 2"]
+
+
+def test_changed_frames_are_evicted():
+    buffer = ReplayBuffer(size=4)
+    for seq in range(1, 4):
+        buffer.record(10, seq, f"frame {seq}")
+    buffer.evict(10, 2)
+    buffer.evict(11, 2)
+    assert buffer.since(10, 0) is None
+    assert buffer.since(10, 2) == ["frame 3"]
@@ -0,0 +1,59 @@
+import hashlib
+import io
+import os
+
+import pytest
+from starlette.datastructures import UploadFile
+
+from app.app.backend import config
+from app.app.backend.storage import store_blob, blob_path, discard_new_blobs
+
+
+def upload(data: bytes, filename: str = "meme.png") -> UploadFile:
+    return UploadFile(io.BytesIO(data), filename=filename)
+
+
+@pytest.mark.asyncio
+async def test_streams_and_hashes(tmp_path):
+    data = os.urandom(10_000)
+    content_hash, size, path, created = await store_blob(upload(data), directory=str(tmp_path), chunk_size=1024)
+    assert created
+    assert content_hash == hashlib.sha256(data).hexdigest()
+    assert size == len(data)
+    assert path == blob_path(content_hash, str(tmp_path))
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+@pytest.mark.asyncio
+async def test_same_content_is_stored_once(tmp_path):
+    data = b"forwarded again and again"
+    first = await store_blob(upload(data, "a.txt"), directory=str(tmp_path))
+    second = await store_blob(upload(data, "b.txt"), directory=str(tmp_path))
+    assert first[:3] == second[:3]
+    assert first[3] and not second[3]
+    stored = [name for _, _, names in os.walk(tmp_path) for name in names]
+    # No temporary file is left behind either
+    assert stored == [first[0]]
+
+
+class RecordedBlobs:
+    def __init__(self, hashes):
+        self.hashes = hashes
+
+    async def fetch(self, _query, hashes):
+        return [{"hash": content_hash} for content_hash in hashes if content_hash in self.hashes]
+
+
+@pytest.mark.asyncio
+async def test_failed_upload_leaves_no_files(tmp_path, monkeypatch):
+    stored = [await store_blob(upload(data), directory=str(tmp_path)) for data in (b"new", b"raced", b"new")]
+    old = await store_blob(upload(b"old"), directory=str(tmp_path))
+    stored.append(await store_blob(upload(b"old"), directory=str(tmp_path)))
+    # Another upload of the same content committed its blob row in the meantime
+    monkeypatch.setattr(config, "db", RecordedBlobs({stored[1][0]}))
+    await discard_new_blobs(stored)
+    assert not os.path.exists(stored[0][2])
+    assert os.path.exists(stored[1][2])
+    # Not created by the failed upload
+    assert os.path.exists(old[2])
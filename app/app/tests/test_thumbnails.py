@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+from app.app.backend import thumbnails
+from app.app.backend.thumbnails import ThumbnailPool, is_image, render_previews
+
+
+def test_is_image():
+    assert is_image("1b4e28ba-2fa1-11d2-883f-0016d3cca427.JPG")
+    assert is_image("meme.webp")
+    assert not is_image("drawing.svg")
+    assert not is_image("report.pdf")
+    assert not is_image("no_extension")
+
+
+def test_nothing_is_queued_without_pillow(monkeypatch):
+    monkeypatch.setattr(thumbnails, "Image", None)
+    pool = ThumbnailPool([64])
+    assert not pool.enqueue("ab" * 32, "/nowhere")
+    assert pool.stats()["queued"] == 0
+
+
+def test_previews_are_small(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    original = tmp_path / "photo.png"
+    Image.effect_noise((1600, 1200), 64).convert("RGB").save(original)
+    previews = render_previews(str(original), "cd" * 32, [64, 256], directory=str(tmp_path / "thumbnails"))
+    assert [size for size, *_ in previews] == [256, 64]
+    for size, path, length, width, height in previews:
+        assert (width, height) == (size, size * 3 // 4)
+        assert length == os.path.getsize(path) < 32 * 1024
+    assert previews[0][2] < os.path.getsize(original) // 10
@@ -0,0 +1,95 @@
+import pytest
+from asyncpg.exceptions import UniqueViolationError
+
+from app.app.backend.exceptions import InvalidRange
+from app.app.backend import config, utils
+from app.app.backend.utils import IdGenerator, SEQUENCE_BITS, MAX_SEQUENCE
+
+
+def test_ids_are_unique_and_increasing():
+    gen = IdGenerator(worker_id=3)
+    ids = [gen.next_id() for _ in range(20000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert all((i >> SEQUENCE_BITS) & 0x3FF == 3 for i in ids)
+
+
+def test_workers_never_collide(monkeypatch):
+    monkeypatch.setattr(IdGenerator, "_now_ms", staticmethod(lambda: utils.ID_EPOCH_MS + 1000))
+    a, b = IdGenerator(worker_id=1), IdGenerator(worker_id=2)
+    assert not {a.next_id() for _ in range(100)} & {b.next_id() for _ in range(100)}
+
+
+def test_clock_going_backwards_stays_monotonic(monkeypatch):
+    now = [utils.ID_EPOCH_MS + 5000]
+    monkeypatch.setattr(IdGenerator, "_now_ms", staticmethod(lambda: now[0]))
+    gen = IdGenerator(worker_id=0)
+    first = gen.next_id()
+    now[0] -= 1000
+    assert gen.next_id() > first
+
+
+def test_sequence_overflow_moves_to_next_millisecond(monkeypatch):
+    monkeypatch.setattr(IdGenerator, "_now_ms", staticmethod(lambda: utils.ID_EPOCH_MS))
+    gen = IdGenerator(worker_id=0)
+    ids = [gen.next_id() for _ in range(MAX_SEQUENCE + 2)]
+    assert len(set(ids)) == len(ids)
+    assert ids[-1] >> (SEQUENCE_BITS + 10) == 1
+
+
+def test_cursor_round_trip():
+    cursor = utils.encode_cursor(42, "x")
+    assert utils.decode_cursor(cursor, (int, str)) == [42, "x"]
+
+
+def test_invalid_cursor():
+    with pytest.raises(InvalidRange):
+        utils.decode_cursor("not a cursor", (int,))
+    with pytest.raises(InvalidRange):
+        utils.decode_cursor(utils.encode_cursor(1, 2), (int,))
+
+
+# Message range and tags (seq), sync (txid, change id), inbox (last activity, chat id), search (rank, message id)
+@pytest.mark.parametrize("types, valid, tampered", [
+    ((int,), [(7,)], [("7",), (7.5,), (True,), (1 << 63,), (None,)]),
+    ((int, int), [(812, 3)], [(812, "3"), ([812], 3), (812, None)]),
+    ((str, int), [("2021-05-01T10:00:00", 5)], [(20210501, 5), ("2021-05-01T10:00:00", "5")]),
+    ((float, int), [(0.0607927, 11), (1, 11)], [("0.06", 11), (0.06, 11.0), (False, 11)]),
+])
+def test_cursor_types(types, valid, tampered):
+    for values in valid:
+        assert utils.decode_cursor(utils.encode_cursor(*values), types) == list(values)
+    for values in tampered:
+        with pytest.raises(InvalidRange):
+            utils.decode_cursor(utils.encode_cursor(*values), types)
+
+
+class CollidingDb:
+    def __init__(self, collisions: int, constraint: str = "chats_pkey"):
+        self.collisions = collisions
+        self.constraint = constraint
+        self.inserted = []
+
+    async def execute(self, _query, uid, *values):
+        if self.collisions:
+            self.collisions -= 1
+            error = UniqueViolationError("duplicate key")
+            error.constraint_name = self.constraint
+            raise error
+        self.inserted.append(uid)
+
+
+@pytest.mark.asyncio
+async def test_taken_ids_are_retried(monkeypatch):
+    monkeypatch.setattr(config, "db", CollidingDb(collisions=2))
+    monkeypatch.setattr(utils, "id_generator", IdGenerator(worker_id=5))
+    uid = await utils.insert_with_unique_id("chats", ("name",), ("x",))
+    assert config.db.inserted == [uid]
+
+    monkeypatch.setattr(config, "db", CollidingDb(collisions=utils.ID_ATTEMPTS))
+    with pytest.raises(UniqueViolationError):
+        await utils.insert_with_unique_id("chats", ("name",), ("x",))
+    # Other unique constraints are not about the id, they are not retried
+    monkeypatch.setattr(config, "db", CollidingDb(collisions=1, constraint="users_nick_key"))
+    with pytest.raises(UniqueViolationError):
+        await utils.insert_with_unique_id("users", ("nick",), ("x",))
@@ -0,0 +1,27 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from app.app.src import wire
+from app.app.src.wire import Frame, JSON, MSGPACK
+
+MESSAGE = {"id": 1, "body": "hi", "sent_time": datetime(2021, 1, 1, tzinfo=timezone.utc)}
+
+
+def test_json_frame_is_compact_and_encoded_once():
+    frame = Frame(MESSAGE)
+    data = frame.encode(JSON)
+    assert data == b'{"id":1,"body":"hi","sent_time":"2021-01-01 00:00:00+00:00"}'
+    assert frame.encode(JSON) is data
+
+
+@pytest.mark.skipif(wire.msgpack is None, reason="msgpack is not installed")
+def test_msgpack_frame_round_trip():
+    frame = Frame(MESSAGE)
+    assert wire.decode(frame.encode(MSGPACK), MSGPACK)["sent_time"] == "2021-01-01 00:00:00+00:00"
+
+
+def test_negotiate():
+    assert wire.negotiate(None) == JSON
+    assert wire.negotiate(["xml", JSON]) == JSON
+    assert wire.negotiate([MSGPACK]) == (MSGPACK if wire.msgpack is not None else JSON)
@@ -0,0 +1,54 @@
+"""
+Compares the CPU cost of encoding one chat message for every recipient of a
+fan-out, the way __send_message_desktop__ used to, with encoding a shared
+Frame once. Run from the repository root:
+
+    python -m benchmarks.bench_wire
+"""
+import json
+import timeit
+from datetime import datetime, timezone
+
+from app.app.src import wire
+from app.app.src.wire import Frame, JSON, MSGPACK
+
+MESSAGE = {
+    "id": 6791238479123456,
+    "chat_attached_id": 6791238479000001,
+    "seq": 1234,
+    "author_id": 6791238400000042,
+    "sent_time": datetime(2021, 5, 1, 12, 30, tzinfo=timezone.utc),
+    "tag_list": ["news", "release"],
+    "body": "The new version of the server is out, please update your clients " * 2,
+    "has_attached_file": False,
+    "was_modified": False,
+    "message_type": "message",
+}
+
+
+def per_recipient(recipients: int) -> None:
+    for _ in range(recipients):
+        json.dumps({**MESSAGE}, indent=4, sort_keys=True, default=str).encode()
+
+
+def shared_frame(recipients: int, encoding: str) -> None:
+    frame = Frame({**MESSAGE})
+    for _ in range(recipients):
+        frame.encode(encoding)
+
+
+def main() -> None:
+    encodings = [JSON] + ([MSGPACK] if wire.msgpack is not None else [])
+    print(f"{'recipients':>10} {'per-recipient us':>17} " + " ".join(f"{'shared ' + e + ' us':>16}" for e in encodings))
+    for recipients in (10, 100, 1000, 5000):
+        number = max(1, 20000 // recipients)
+        old = timeit.timeit(lambda: per_recipient(recipients), number=number) / number * 1e6
+        new = [timeit.timeit(lambda: shared_frame(recipients, e), number=number) / number * 1e6 for e in encodings]
+        print(f"{recipients:>10} {old:>17.1f} " + " ".join(f"{t:>16.1f}" for t in new))
+    print()
+    print(f"frame size: pretty JSON {len(json.dumps(MESSAGE, indent=4, sort_keys=True, default=str))} bytes, "
+          + ", ".join(f"{e} {len(Frame(MESSAGE).encode(e))} bytes" for e in encodings))
+
+
+if __name__ == "__main__":
+    main()